@@ -0,0 +1,581 @@
+"""
+Benchmarks for the DocTalk websocket backend.
+
+Uses the same .env as main.py. Examples:
+    python bench.py relay-latency sample.pdf --jobs 4
+    python bench.py retrieval <user_id> "what is the expiry date?" --repeat 50
+    python bench.py first-audio ws://localhost:9084 <user_id> question.pcm
+    python bench.py relay-throughput --frames 20000
+    python bench.py session-start --sessions 20 --pool-size 2
+    python bench.py startup
+    python bench.py offline --pages 100 --sessions 10 --error-rate 0.01
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import websockets
+
+import main
+from bench_fakes import (
+    FakeEmbedding, FakeLLM, FakeLiveServer, FakeSupabase, FakeVisionClient, Latency,
+    pcm_with_sequence, sequence_of,
+)
+
+NULL = open(os.devnull, "w")
+
+
+def percentiles(samples):
+    """p50/p99/max of a list of seconds, in milliseconds"""
+    if not samples:
+        return {"p50": 0.0, "p99": 0.0, "max": 0.0}
+    ordered = sorted(samples)
+    p99_index = min(len(ordered) - 1, int(len(ordered) * 0.99))
+    return {
+        "p50": statistics.median(ordered) * 1000,
+        "p99": ordered[p99_index] * 1000,
+        "max": ordered[-1] * 1000,
+    }
+
+
+def print_row(label, stats):
+    print(f"  {label:<10} p50={stats['p50']:8.2f}ms  p99={stats['p99']:8.2f}ms  max={stats['max']:8.2f}ms")
+
+
+# === Relay latency under ingestion load ===
+async def measure_loop_lag(stop, interval=0.005):
+    """
+    Every relayed frame waits for the event loop, so the extra delay on a
+    short sleep is the latency a frame would pick up while ingestion runs.
+    """
+    lags = []
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - started - interval)
+    return lags
+
+
+async def relay_latency_run(mode, pdf_bytes, jobs):
+    stop = asyncio.Event()
+    lag_task = asyncio.create_task(measure_loop_lag(stop))
+    await asyncio.sleep(0.2)
+    if mode == "idle":
+        await asyncio.sleep(1.0)
+    elif mode == "inline":
+        # What the handler used to do: parse on the event loop itself
+        for _ in range(jobs):
+            main.extract_text_no_ocr(pdf_bytes)
+            await asyncio.sleep(0)
+    else:
+        # The handler's path: extraction, chunking and embedding on the I/O pool
+        await asyncio.gather(*(
+            main.run_io(main.store_chunks_and_embeddings, f"bench-relay-{i}", "relay.pdf", main.iter_page_texts(pdf_bytes))
+            for i in range(jobs)
+        ))
+    stop.set()
+    return await lag_task
+
+
+async def bench_relay_latency(args):
+    print(f"Relay latency while ingesting {args.jobs}x {args.pdf}")
+    with open(args.pdf, "rb") as f:
+        pdf_bytes = f.read()
+    # Ingest into the local fakes so the benchmark writes nothing to Supabase
+    install_fakes(argparse.Namespace(
+        error_rate=0.0, supabase_ms=args.supabase_ms, embed_ms=args.embed_ms, llm_ms=0.0, vision_ms=0.0,
+    ))
+    for mode in ("idle", "inline", "ingesting"):
+        lags = await relay_latency_run(mode, pdf_bytes, args.jobs)
+        print_row(mode, percentiles(lags))
+
+
+# === Retrieval backends ===
+async def bench_retrieval(args):
+    embeddings = [main.embed_query(query) for query in args.queries]
+    local = main.LocalVectorIndex()
+    started = time.perf_counter()
+    local.acquire_user(args.user_id)
+    print(f"Local index load: {(time.perf_counter() - started) * 1000:.1f}ms")
+
+    backends = {"supabase": main.SupabaseRetriever(), "local": local}
+    print(f"Top-{main.MATCH_COUNT} search latency over {len(embeddings)} queries x {args.repeat}")
+    for name, backend in backends.items():
+        samples = []
+        for _ in range(args.repeat):
+            for embedding in embeddings:
+                started = time.perf_counter()
+                backend.search(args.user_id, embedding)
+                samples.append(time.perf_counter() - started)
+        print_row(name, percentiles(samples))
+    local.release_user(args.user_id)
+
+
+# === Time to first audio per answer mode ===
+PCM_CHUNK_BYTES = 3200  # 100ms of 16kHz 16-bit mono, what the browser sends
+
+
+def pcm_frame(pcm):
+    """Audio message exactly as the browser's JSON.stringify produces it"""
+    return json.dumps({
+        "realtime_input": {
+            "media_chunks": [{"mime_type": "audio/pcm", "data": base64.b64encode(pcm).decode()}]
+        }
+    }, separators=(",", ":"))
+
+
+async def first_audio_run(url, user_id, answer_mode, pcm, timeout):
+    """Speak the question in real time; return seconds from end of speech to first text delta and first audio"""
+    async with websockets.connect(url, max_size=None) as ws:
+        await ws.send(json.dumps({"setup": {"user_id": user_id, "answer_mode": answer_mode}}))
+        for i in range(0, len(pcm), PCM_CHUNK_BYTES):
+            await ws.send(pcm_frame(pcm[i:i + PCM_CHUNK_BYTES]))
+            await asyncio.sleep(0.1)
+        speech_ended = time.perf_counter()
+
+        async def trailing_silence():
+            # Give the Live API's voice activity detection a clean end of turn
+            for _ in range(20):
+                await ws.send(pcm_frame(bytes(PCM_CHUNK_BYTES)))
+                await asyncio.sleep(0.1)
+
+        silence = asyncio.create_task(trailing_silence())
+        first_text = None
+        try:
+            async with asyncio.timeout(timeout):
+                async for message in ws:
+                    data = json.loads(message)
+                    if first_text is None and ("answer_delta" in data or "text" in data):
+                        first_text = time.perf_counter() - speech_ended
+                    if "audio" in data:
+                        return first_text, time.perf_counter() - speech_ended
+        finally:
+            silence.cancel()
+    return first_text, None
+
+
+async def bench_first_audio(args):
+    with open(args.pcm, "rb") as f:
+        pcm = f.read()
+    print(f"Time to first audio after {len(pcm) / 32000:.1f}s of speech, {args.repeat} runs per mode")
+    for answer_mode in args.modes:
+        text_samples, audio_samples = [], []
+        for _ in range(args.repeat):
+            try:
+                first_text, first_audio = await first_audio_run(args.url, args.user_id, answer_mode, pcm, args.timeout)
+            except TimeoutError:
+                print(f"  {answer_mode}: run timed out")
+                continue
+            if first_text is not None:
+                text_samples.append(first_text)
+            if first_audio is not None:
+                audio_samples.append(first_audio)
+        print(f"  [{answer_mode}]")
+        print_row("text", percentiles(text_samples))
+        print_row("audio", percentiles(audio_samples))
+
+
+# === Relay CPU cost per frame ===
+def legacy_upstream(message):
+    data = json.loads(message)
+    for chunk in data["realtime_input"].get("media_chunks", []):
+        if chunk.get("mime_type") == "audio/pcm":
+            return json.dumps(data)
+
+
+def legacy_downstream(raw_response):
+    response = json.loads(raw_response)
+    print(f"🔍 Full response: {json.dumps(response, indent=2, default=str)[:500]}...", file=NULL)
+    server_content = response["serverContent"]
+    print(f"📦 Server content: {json.dumps(server_content, indent=2, default=str)[:500]}...", file=NULL)
+    for part in server_content["modelTurn"]["parts"]:
+        print(f"🔸 Part: {json.dumps(part, indent=2, default=str)[:200]}...", file=NULL)
+        return json.dumps({"audio": part["inlineData"]["data"]})
+
+
+def fast_downstream(raw_response, binary_audio):
+    response = json.loads(raw_response)
+    for part in response["serverContent"]["modelTurn"]["parts"]:
+        return main.client_audio_frame(part["inlineData"]["data"], binary_audio)
+
+
+def frames_per_second(fn, frames):
+    started = time.process_time()  # CPU time, so the result is per core
+    for frame in frames:
+        fn(frame)
+    return len(frames) / (time.process_time() - started)
+
+
+async def bench_relay_throughput(args):
+    mic_pcm = bytes(PCM_CHUNK_BYTES)
+    client_json = pcm_frame(mic_pcm)
+    speaker_b64 = base64.b64encode(bytes(4800)).decode()  # 100ms of 24kHz Gemini audio
+    gemini_json = json.dumps({"serverContent": {"modelTurn": {"parts": [
+        {"inlineData": {"mimeType": "audio/pcm;rate=24000", "data": speaker_b64}}
+    ]}}})
+
+    cases = [
+        ("client->gemini  legacy json", legacy_upstream, client_json),
+        ("client->gemini  fast json", main.upstream_audio_frame, client_json),
+        ("client->gemini  binary", main.upstream_audio_frame, mic_pcm),
+        ("gemini->client  legacy", legacy_downstream, gemini_json),
+        ("gemini->client  fast json", lambda raw: fast_downstream(raw, False), gemini_json),
+        ("gemini->client  binary", lambda raw: fast_downstream(raw, True), gemini_json),
+    ]
+    print(f"Relay frames/sec per core ({args.frames} frames)")
+    for label, fn, frame in cases:
+        print(f"  {label:<28} {frames_per_second(fn, [frame] * args.frames):>12,.0f}")
+
+
+# === Gemini session start with and without the pool ===
+async def bench_session_start(args):
+    answer_mode = main.DEFAULT_ANSWER_MODE
+    print(f"Gemini Live session start, {args.sessions} sessions {args.interval}s apart")
+
+    cold = []
+    for _ in range(args.sessions):
+        started = time.perf_counter()
+        gemini_ws = await main.open_gemini_session(answer_mode)
+        cold.append(time.perf_counter() - started)
+        await gemini_ws.close()
+        await asyncio.sleep(args.interval)
+    print_row("no pool", percentiles(cold))
+
+    pool = main.GeminiSessionPool(size=args.pool_size)
+    pool.start((answer_mode,))
+    await asyncio.sleep(args.warmup)
+    for _ in range(args.sessions):
+        gemini_ws, _ = await pool.acquire(answer_mode)
+        await gemini_ws.close()
+        await asyncio.sleep(args.interval)
+    await pool.close()
+    for kind, stats in pool.stats().items():
+        print(f"  {'pool/' + kind:<10} p50={stats['p50']:8.2f}ms  p95={stats['p95']:8.2f}ms  "
+              f"p99={stats['p99']:8.2f}ms  ({stats['count']} sessions)")
+
+
+# === Startup cost ===
+STARTUP_PROBE = """
+import json, time
+started = time.perf_counter()
+import main
+timings = [("import main", time.perf_counter() - started)]
+for label, init in [
+    ("supabase client", main.get_supabase),
+    ("node parser", main.get_parser),
+    ("embedding model", main.get_embedding_model),
+    ("llm", main.get_llm),
+    ("vision client", main.get_vision_client),
+    ("speech client", main.get_speech_client),
+    ("embedding probe", main.verify_embedding_dimension),
+]:
+    started = time.perf_counter()
+    init()
+    timings.append((label, time.perf_counter() - started))
+print(json.dumps(timings))
+"""
+
+
+def time_to_port_open(port, timeout):
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "main.py"],
+        env={**os.environ, "PORT": str(port), "WEB_CONCURRENCY": "1"},
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        while time.perf_counter() - started < timeout:
+            try:
+                with socket.create_connection(("127.0.0.1", port), timeout=0.1):
+                    return time.perf_counter() - started
+            except OSError:
+                time.sleep(0.01)
+        return None
+    finally:
+        server.terminate()
+        server.wait()
+
+
+async def bench_startup(args):
+    print("Startup breakdown (fresh interpreter, each step after the previous)")
+    output = subprocess.run([sys.executable, "-c", STARTUP_PROBE], capture_output=True, text=True, check=True)
+    timings = json.loads(output.stdout.strip().splitlines()[-1])
+    for label, seconds in timings:
+        print(f"  {label:<18} {seconds * 1000:9.1f}ms")
+    print(f"  {'total':<18} {sum(seconds for _, seconds in timings) * 1000:9.1f}ms")
+
+    port_open = time_to_port_open(args.port, args.timeout)
+    if port_open is None:
+        print(f"  port {args.port} did not open within {args.timeout:.0f}s")
+    else:
+        print(f"  {'python main.py to port open':<28} {port_open * 1000:9.1f}ms")
+
+
+# === Offline end-to-end with local fakes ===
+BENCH_USER = "bench-user"
+BENCH_WORDS = (
+    "revenue", "contract", "invoice", "warranty", "expiry", "clause", "payment", "tenant",
+    "liability", "renewal", "notice", "period", "supplier", "delivery", "schedule", "penalty",
+    "insurance", "premium", "deductible", "claim", "policy", "holder", "coverage", "exclusion",
+    "salary", "bonus", "equity", "vesting", "quarter", "forecast", "budget", "audit",
+)
+
+
+def synthetic_pdf(pages, seed, words_per_page=300):
+    """A text-layer PDF of random domain words, different for each seed"""
+    import fitz
+    rng = random.Random(seed)
+    doc = fitz.open()
+    for n in range(pages):
+        page = doc.new_page()
+        text = f"Section {n % 7}. " + " ".join(rng.choice(BENCH_WORDS) for _ in range(words_per_page))
+        page.insert_textbox(fitz.Rect(36, 36, page.rect.width - 36, page.rect.height - 36), text, fontsize=8)
+    pdf_bytes = doc.tobytes()
+    doc.close()
+    return pdf_bytes
+
+
+def install_fakes(args):
+    """Point main.py's client accessors, job store and Live endpoint at local fakes"""
+    def latency(ms, seed):
+        return Latency(ms, error_rate=args.error_rate, seed=seed)
+
+    supabase = FakeSupabase(latency(args.supabase_ms, 1))
+    embedding = FakeEmbedding(latency=latency(args.embed_ms, 2))
+    llm = FakeLLM(latency(args.llm_ms, 3))
+    vision = FakeVisionClient(latency(args.vision_ms, 4))
+    main.get_supabase = lambda: supabase
+    main.get_embedding_model = lambda: embedding
+    main.get_llm = lambda: llm
+    main.get_vision_client = lambda: vision
+    main.retriever = main.SupabaseRetriever()
+    main.ingest_jobs = main.IngestJobStore(os.path.join(tempfile.mkdtemp(prefix="doctalk-bench-"), "jobs.sqlite3"))
+    main.gemini_pool = main.GeminiSessionPool(size=0)
+    return supabase
+
+
+class MessageSink:
+    """Stands in for a client websocket that only receives"""
+
+    def __init__(self):
+        self.messages = []
+
+    async def send(self, message):
+        self.messages.append(message)
+
+
+def print_rate(label, count, unit, seconds):
+    print(f"  {label:<28} {count / seconds:10.1f} {unit}/s  ({count} in {seconds:.2f}s)")
+
+
+async def offline_ingest(args, supabase):
+    pdf_bytes = synthetic_pdf(args.pages, seed=1)
+    started = time.perf_counter()
+    try:
+        await main.run_io(main.store_chunks_and_embeddings, BENCH_USER, "ingest.pdf", main.iter_page_texts(pdf_bytes))
+        print_rate("store_chunks_and_embeddings", args.pages, "pages", time.perf_counter() - started)
+    except Exception as e:
+        print(f"  {'store_chunks_and_embeddings':<28} FAILED after {time.perf_counter() - started:.2f}s: {e}")
+
+    started = time.perf_counter()
+    texts = await main.run_io(list, main.iter_page_texts(synthetic_pdf(args.ocr_pages, seed=2), True))
+    elapsed = time.perf_counter() - started
+    # ocr_page falls back to the text layer on any failure, so look for the fake's text
+    fallbacks = sum(1 for text in texts if not text.startswith("ocr"))
+    if fallbacks:
+        print(f"  {'OCR pages':<28} FAILED after {elapsed:.2f}s: {fallbacks}/{len(texts)} pages fell back to the text layer")
+    else:
+        print_rate("OCR pages", args.ocr_pages, "pages", elapsed)
+
+    storage_path = f"{BENCH_USER}/upload.pdf"
+    supabase.storage.from_("pdfs").upload(storage_path, synthetic_pdf(args.pages, seed=3))
+    sink = MessageSink()
+    main.user_sockets[BENCH_USER] = {sink}
+    started = time.perf_counter()
+    await main.process_pdf(sink, BENCH_USER, {"filename": "upload.pdf", "storage_path": storage_path, "ocr": False})
+    elapsed = time.perf_counter() - started
+    main.user_sockets.pop(BENCH_USER, None)
+    messages = [json.loads(message) for message in sink.messages]
+    statuses = [message["ingest_progress"]["status"] for message in messages if "ingest_progress" in message]
+    texts = [message["text"] for message in messages if message.get("text")]
+    if statuses[-1:] == ["done"]:
+        print_rate("process_pdf", args.pages, "pages", elapsed)
+    else:
+        print(f"  {'process_pdf':<28} FAILED after {elapsed:.2f}s: {texts[-1:]}")
+    print(f"  {'':<28} {len(supabase.tables.get('document_chunks', []))} chunk rows stored")
+
+
+async def offline_query(args):
+    rng = random.Random(5)
+    # Distinct queries, so every one misses the query caches
+    queries = [f"what does section {i % 7} say about {rng.choice(BENCH_WORDS)} ({i})" for i in range(args.queries)]
+    concurrency = asyncio.Semaphore(args.query_concurrency)
+    samples = []
+    failures = []
+
+    async def timed_query(query):
+        async with concurrency:
+            started = time.perf_counter()
+            # query_docs reports errors as its answer rather than raising
+            answer = await main.query_docs_async(query, BENCH_USER)
+            if answer.startswith("Error:"):
+                failures.append(answer)
+            else:
+                samples.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(timed_query(query) for query in queries))
+    print_rate("query_docs", len(samples), "queries", time.perf_counter() - started)
+    print_row("query", percentiles(samples))
+    if failures:
+        print(f"  {'':<10} {len(failures)}/{len(queries)} failed (excluded), e.g. {failures[0]}")
+
+
+async def offline_relay_session(url, args):
+    """One client streaming audio through gemini_session_handler; returns per-frame round trips"""
+    sent_at = {}
+    round_trips = []
+    async with websockets.connect(url, max_size=None) as ws:
+        await ws.send(json.dumps({"setup": {"user_id": BENCH_USER, "binary_audio": args.binary}}))
+
+        async def send_frames():
+            for sequence in range(args.frames):
+                pcm = pcm_with_sequence(sequence, PCM_CHUNK_BYTES)
+                sent_at[sequence] = time.perf_counter()
+                await ws.send(pcm if args.binary else pcm_frame(pcm))
+                await asyncio.sleep(args.frame_interval)
+
+        sender = asyncio.create_task(send_frames())
+        try:
+            async with asyncio.timeout(args.timeout):
+                async for message in ws:
+                    if isinstance(message, bytes):
+                        pcm = message
+                    else:
+                        data = json.loads(message)
+                        if "audio" not in data:
+                            continue
+                        pcm = base64.b64decode(data["audio"])
+                    round_trips.append(time.perf_counter() - sent_at[sequence_of(pcm)])
+                    if len(round_trips) == args.frames:
+                        break
+        except TimeoutError:
+            pass
+        finally:
+            sender.cancel()
+    return round_trips
+
+
+async def offline_relay(args):
+    live = FakeLiveServer(Latency(args.live_ms, error_rate=args.error_rate, seed=6), tool_every=args.tool_every)
+    main.GEMINI_URI = await live.start()
+    server = await websockets.serve(main.gemini_session_handler, "127.0.0.1", 0, max_size=None)
+    url = f"ws://127.0.0.1:{server.sockets[0].getsockname()[1]}"
+    try:
+        started = time.perf_counter()
+        results = await asyncio.gather(*(offline_relay_session(url, args) for _ in range(args.sessions)))
+        elapsed = time.perf_counter() - started
+    finally:
+        server.close()
+        await server.wait_closed()
+        await live.stop()
+    round_trips = [rtt for result in results for rtt in result]
+    print_rate(f"relay ({args.sessions} sessions)", len(round_trips), "frames", elapsed)
+    print(f"  {'':<28} {len(round_trips)}/{args.sessions * args.frames} frames returned, "
+          f"{live.tool_calls} tool calls, {live.tool_responses} answered")
+    print_row("frame rtt", percentiles(round_trips))
+
+
+async def bench_offline(args):
+    supabase = install_fakes(args)
+    print(f"Offline run against local fakes (error rate {args.error_rate:.1%})")
+    if "ingest" in args.stages:
+        await offline_ingest(args, supabase)
+    if "query" in args.stages:
+        if not supabase.tables.get("document_chunks"):
+            await main.run_io(main.store_chunks_and_embeddings, BENCH_USER, "ingest.pdf",
+                              main.iter_page_texts(synthetic_pdf(args.pages, seed=1)))
+        await offline_query(args)
+    if "relay" in args.stages:
+        await offline_relay(args)
+
+
+BENCHMARKS = {
+    "relay-latency": bench_relay_latency,
+    "retrieval": bench_retrieval,
+    "first-audio": bench_first_audio,
+    "relay-throughput": bench_relay_throughput,
+    "session-start": bench_session_start,
+    "startup": bench_startup,
+    "offline": bench_offline,
+}
+
+
+def build_arg_parser():
+    arg_parser = argparse.ArgumentParser(description="DocTalk backend benchmarks")
+    sub = arg_parser.add_subparsers(dest="benchmark", required=True)
+
+    relay = sub.add_parser("relay-latency", help="event loop latency while PDFs are ingested")
+    relay.add_argument("pdf")
+    relay.add_argument("--jobs", type=int, default=4)
+    relay.add_argument("--supabase-ms", type=float, default=20, help="fake supabase latency per call")
+    relay.add_argument("--embed-ms", type=float, default=80, help="fake embed latency per call")
+
+    retrieval = sub.add_parser("retrieval", help="match_document_chunks RPC vs local vector index")
+    retrieval.add_argument("user_id")
+    retrieval.add_argument("queries", nargs="+")
+    retrieval.add_argument("--repeat", type=int, default=20)
+
+    first_audio = sub.add_parser("first-audio", help="time to first audio for each answer_mode")
+    first_audio.add_argument("url")
+    first_audio.add_argument("user_id")
+    first_audio.add_argument("pcm", help="raw 16kHz 16-bit mono PCM of a spoken question")
+    first_audio.add_argument("--modes", nargs="+", default=list(main.ANSWER_MODES))
+    first_audio.add_argument("--repeat", type=int, default=5)
+    first_audio.add_argument("--timeout", type=float, default=30)
+
+    throughput = sub.add_parser("relay-throughput", help="CPU cost of relaying audio frames")
+    throughput.add_argument("--frames", type=int, default=20000)
+
+    session_start = sub.add_parser("session-start", help="Gemini Live session start latency, cold vs pooled")
+    session_start.add_argument("--sessions", type=int, default=20)
+    session_start.add_argument("--pool-size", type=int, default=2)
+    session_start.add_argument("--interval", type=float, default=1.0, help="seconds between session starts")
+    session_start.add_argument("--warmup", type=float, default=5.0, help="seconds to let the pool fill")
+
+    startup = sub.add_parser("startup", help="import, client init and time-to-port-open breakdown")
+    startup.add_argument("--port", type=int, default=9185)
+    startup.add_argument("--timeout", type=float, default=60)
+
+    offline = sub.add_parser("offline", help="real code paths against local Supabase/Gemini/Vision fakes")
+    offline.add_argument("--stages", nargs="+", choices=("ingest", "query", "relay"), default=["ingest", "query", "relay"])
+    offline.add_argument("--pages", type=int, default=50)
+    offline.add_argument("--ocr-pages", type=int, default=10)
+    offline.add_argument("--queries", type=int, default=100)
+    offline.add_argument("--query-concurrency", type=int, default=4)
+    offline.add_argument("--sessions", type=int, default=10, help="concurrent relay sessions")
+    offline.add_argument("--frames", type=int, default=200, help="audio frames per relay session")
+    offline.add_argument("--frame-interval", type=float, default=0.0, help="seconds between frames (0.1 is real time)")
+    offline.add_argument("--binary", action="store_true", help="binary PCM frames in both directions")
+    offline.add_argument("--tool-every", type=int, default=100, help="fake Live tool call every N frames (0 disables)")
+    offline.add_argument("--timeout", type=float, default=60)
+    offline.add_argument("--error-rate", type=float, default=0.0, help="injected failure rate for every fake call")
+    for service, ms in (("supabase", 20), ("embed", 80), ("llm", 400), ("vision", 300), ("live", 30)):
+        offline.add_argument(f"--{service}-ms", type=float, default=ms, help=f"fake {service} latency per call")
+
+    return arg_parser
+
+
+if __name__ == "__main__":
+    args = build_arg_parser().parse_args()
+    asyncio.run(BENCHMARKS[args.benchmark](args))
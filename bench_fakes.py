@@ -0,0 +1,368 @@
+"""
+Local stand-ins for Supabase, Gemini (embeddings, LLM and the Live API) and
+Vision, so `python bench.py offline` can drive main.py's real code paths
+without network access.
+
+Every fake call waits for its configured latency and fails at its configured
+error rate, which also exercises main.py's retry and fallback paths.
+"""
+import asyncio
+import hashlib
+import json
+import math
+import random
+import threading
+import time
+from types import SimpleNamespace
+
+import websockets
+
+
+class FakeServiceError(Exception):
+    """An injected failure"""
+
+
+class Latency:
+    """Per-call delay in ms (with +/- jitter) and error rate for one fake service"""
+
+    def __init__(self, ms=0.0, jitter=0.2, error_rate=0.0, seed=0):
+        self.ms = ms
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _draw(self):
+        with self._lock:
+            scale = self._random.uniform(1 - self.jitter, 1 + self.jitter)
+            failed = self._random.random() < self.error_rate
+        return self.ms / 1000 * scale, failed
+
+    def wait(self, label):
+        seconds, failed = self._draw()
+        time.sleep(seconds)
+        if failed:
+            raise FakeServiceError(f"injected {label} failure")
+
+    async def wait_async(self, label):
+        seconds, failed = self._draw()
+        await asyncio.sleep(seconds)
+        if failed:
+            raise FakeServiceError(f"injected {label} failure")
+
+
+# === Supabase ===
+class FakeResponse:
+    def __init__(self, data):
+        self.data = data
+
+
+class FakeQuery:
+    """The subset of the postgrest query builder main.py uses"""
+
+    def __init__(self, db, table):
+        self.db = db
+        self.table = table
+        self.op = "select"
+        self.columns = None
+        self.values = None
+        self.conflict_keys = None
+        self.filters = []
+        self.order_by = None
+        self.bounds = None
+
+    def select(self, columns="*"):
+        self.op = "select"
+        if columns != "*":
+            self.columns = [column.strip() for column in columns.split(",")]
+        return self
+
+    def insert(self, rows):
+        self.op = "insert"
+        self.values = rows if isinstance(rows, list) else [rows]
+        return self
+
+    def upsert(self, row, on_conflict=""):
+        self.op = "upsert"
+        self.values = row
+        self.conflict_keys = [key.strip() for key in on_conflict.split(",") if key.strip()]
+        return self
+
+    def update(self, values):
+        self.op = "update"
+        self.values = values
+        return self
+
+    def delete(self):
+        self.op = "delete"
+        return self
+
+    def match(self, criteria):
+        self.filters.append(lambda row: all(row.get(key) == value for key, value in criteria.items()))
+        return self
+
+    def in_(self, column, values):
+        values = set(values)
+        self.filters.append(lambda row: row.get(column) in values)
+        return self
+
+    def order(self, column):
+        self.order_by = column
+        return self
+
+    def range(self, start, end):
+        self.bounds = (start, end + 1)
+        return self
+
+    def _matching(self, rows):
+        return [row for row in rows if all(f(row) for f in self.filters)]
+
+    def _project(self, row):
+        columns = self.columns or list(row)
+        # pgvector columns come back as text
+        return {c: json.dumps(row[c]) if c == "embedding" else row.get(c) for c in columns}
+
+    def execute(self):
+        self.db.latency.wait(f"{self.table} {self.op}")
+        with self.db.lock:
+            rows = self.db.tables.setdefault(self.table, [])
+            if self.op == "select":
+                found = self._matching(rows)
+                if self.order_by:
+                    found.sort(key=lambda row: row[self.order_by])
+                if self.bounds:
+                    found = found[self.bounds[0]:self.bounds[1]]
+                return FakeResponse([self._project(row) for row in found])
+            if self.op == "insert":
+                inserted = [self.db.new_row(values) for values in self.values]
+                rows.extend(inserted)
+                return FakeResponse(inserted)
+            if self.op == "upsert":
+                key = {k: self.values.get(k) for k in self.conflict_keys}
+                existing = [row for row in rows if all(row.get(k) == v for k, v in key.items())]
+                if existing:
+                    existing[0].update(self.values)
+                    return FakeResponse(existing[:1])
+                rows.append(self.db.new_row(self.values))
+                return FakeResponse(rows[-1:])
+            found = self._matching(rows)
+            if self.op == "update":
+                for row in found:
+                    row.update(self.values)
+            else:
+                removed = {row["id"] for row in found}
+                self.db.tables[self.table] = [row for row in rows if row["id"] not in removed]
+            return FakeResponse(found)
+
+
+class FakeRPC:
+    def __init__(self, db, name, params):
+        self.db = db
+        self.name = name
+        self.params = params
+
+    def execute(self):
+        self.db.latency.wait(f"rpc {self.name}")
+        if self.name != "match_document_chunks":
+            raise FakeServiceError(f"unknown rpc {self.name}")
+        query = self.params["query_embedding"]
+        with self.db.lock:
+            rows = [row for row in self.db.tables.get("document_chunks", [])
+                    if row["user_id"] == self.params["match_user_id"]]
+        scored = sorted(rows, key=lambda row: -sum(a * b for a, b in zip(query, row["embedding"])))
+        columns = ("chunk", "filename", "page_start", "page_end", "section")
+        return FakeResponse([{c: row.get(c) for c in columns} for row in scored[:self.params["match_count"]]])
+
+
+class FakeBucket:
+    def __init__(self, storage, name):
+        self.storage = storage
+        self.name = name
+
+    def upload(self, path, data):
+        self.storage.objects[(self.name, path)] = data
+
+    def download(self, path):
+        self.storage.latency.wait("storage download")
+        return self.storage.objects[(self.name, path)]
+
+    def remove(self, paths):
+        self.storage.latency.wait("storage remove")
+        for path in paths:
+            self.storage.objects.pop((self.name, path), None)
+
+
+class FakeStorage:
+    def __init__(self, latency):
+        self.latency = latency
+        self.objects = {}
+
+    def from_(self, bucket):
+        return FakeBucket(self, bucket)
+
+
+class FakeSupabase:
+    """In-memory tables, the match_document_chunks RPC and the pdfs bucket"""
+
+    def __init__(self, latency=None):
+        self.latency = latency or Latency()
+        self.lock = threading.Lock()
+        self.tables = {}
+        self.storage = FakeStorage(self.latency)
+        self._next_id = 1
+
+    def new_row(self, values):
+        row = dict(values, id=self._next_id)
+        self._next_id += 1
+        return row
+
+    def table(self, name):
+        return FakeQuery(self, name)
+
+    def rpc(self, name, params):
+        return FakeRPC(self, name, params)
+
+
+# === Gemini models ===
+class FakeEmbedding:
+    """Deterministic bag-of-words hashing embedding, so similar texts score alike"""
+
+    def __init__(self, dimension=768, latency=None):
+        self.dimension = dimension
+        self.latency = latency or Latency()
+
+    def _embed(self, text):
+        vector = [0.0] * self.dimension
+        for word in text.lower().split():
+            digest = hashlib.blake2b(word.encode("utf-8"), digest_size=4).digest()
+            vector[int.from_bytes(digest, "little") % self.dimension] += 1.0
+        norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+        return [x / norm for x in vector]
+
+    def get_text_embedding(self, text):
+        self.latency.wait("embedding")
+        return self._embed(text)
+
+    def get_text_embedding_batch(self, texts):
+        self.latency.wait("embedding batch")
+        return [self._embed(text) for text in texts]
+
+
+class FakeLLM:
+    """Answers with the first words of the prompt's context; latency is per completion"""
+
+    def __init__(self, latency=None, answer_words=40, stream_tokens=10):
+        self.latency = latency or Latency()
+        self.answer_words = answer_words
+        self.stream_tokens = stream_tokens
+
+    def _answer(self, prompt):
+        return " ".join(prompt.split()[1:self.answer_words + 1])
+
+    def complete(self, prompt):
+        self.latency.wait("llm complete")
+        return _Completion(self._answer(prompt))
+
+    def stream_complete(self, prompt):
+        words = self._answer(prompt).split()
+        step = max(1, math.ceil(len(words) / self.stream_tokens))
+        for i in range(0, len(words), step):
+            time.sleep(self.latency.ms / 1000 / self.stream_tokens)
+            yield SimpleNamespace(delta=" ".join(words[i:i + step]) + " ")
+
+
+class _Completion:
+    def __init__(self, text):
+        self.text = text
+
+    def __str__(self):
+        return self.text
+
+
+# === Vision ===
+class FakeVisionClient:
+    """document_text_detection returning fixed text sized to the rendered page"""
+
+    def __init__(self, latency=None):
+        self.latency = latency or Latency()
+
+    def document_text_detection(self, image):
+        self.latency.wait("vision")
+        words = max(1, len(image["content"]) // 200)
+        return SimpleNamespace(
+            error=SimpleNamespace(message=""),
+            full_text_annotation=SimpleNamespace(text=" ".join(["ocr"] * words)),
+        )
+
+
+# === Gemini Live ===
+class FakeLiveServer:
+    """
+    Speaks the BidiGenerateContent handshake and answers each upstream audio
+    frame with one audio frame of the same PCM after `latency`. Every
+    `tool_every` frames it also issues a query_docs tool call.
+    """
+
+    def __init__(self, latency=None, tool_every=0):
+        self.latency = latency or Latency()
+        self.tool_every = tool_every
+        self.frames = 0
+        self.tool_calls = 0
+        self.tool_responses = 0
+        self._server = None
+
+    async def start(self):
+        self._server = await websockets.serve(self._handle, "127.0.0.1", 0, max_size=None)
+        port = self._server.sockets[0].getsockname()[1]
+        return f"ws://127.0.0.1:{port}"
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _reply_later(self, websocket, payload):
+        try:
+            await self.latency.wait_async("live frame")
+            await websocket.send(payload)
+        except (FakeServiceError, websockets.exceptions.ConnectionClosed):
+            pass
+
+    async def _handle(self, websocket):
+        await websocket.recv()  # setup
+        await websocket.send(json.dumps({"setupComplete": {}}))
+        replies = set()
+        try:
+            async for message in websocket:
+                data = json.loads(message)
+                if "tool_response" in data:
+                    self.tool_responses += 1
+                    continue
+                for chunk in data.get("realtime_input", {}).get("media_chunks", []):
+                    self.frames += 1
+                    payload = json.dumps({"serverContent": {"modelTurn": {"parts": [
+                        {"inlineData": {"mimeType": "audio/pcm;rate=24000", "data": chunk["data"]}}
+                    ]}}})
+                    task = asyncio.create_task(self._reply_later(websocket, payload))
+                    replies.add(task)
+                    task.add_done_callback(replies.discard)
+                    if self.tool_every and self.frames % self.tool_every == 0:
+                        self.tool_calls += 1
+                        await websocket.send(json.dumps({"toolCall": {"functionCalls": [{
+                            "id": f"call-{self.tool_calls}",
+                            "name": "query_docs",
+                            "args": {"query": f"what does section {self.tool_calls % 7} say about revenue"},
+                        }]}}))
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            for task in replies:
+                task.cancel()
+
+
+def pcm_with_sequence(sequence, size):
+    """Silent PCM frame carrying its sequence number in the first 8 bytes"""
+    return sequence.to_bytes(8, "little") + bytes(size - 8)
+
+
+def sequence_of(pcm):
+    return int.from_bytes(pcm[:8], "little")
\ No newline at end of file
@@ -3,18 +3,27 @@ import json
 import os
 import websockets
 import base64
+import time
+import uuid
+import functools
+import contextlib
+import contextvars
+import hashlib
+import threading
+import multiprocessing
+import signal
+import fcntl
+import zlib
+import re
+import sqlite3
+import queue
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from dotenv import load_dotenv
 
-# Supabase + OCR + Vector
-from supabase import create_client
-import fitz
-from google.cloud import vision
-from llama_index.core.node_parser import SimpleNodeParser
-from llama_index.embeddings.gemini import GeminiEmbedding
-from llama_index.llms.gemini import Gemini
-from llama_index.core import Document
-
-from google.cloud import speech
+# Supabase, PyMuPDF, Google Cloud, LlamaIndex and NumPy are imported where they
+# are first used: together they take seconds to import and the server should bind
+# its port without waiting for them.
 
 load_dotenv()
 
@@ -24,158 +33,1189 @@ gemini_api_key = os.getenv('GOOGLE_API_KEY')
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_SERVICE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
 
-supabase = create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY)
-vision_client = vision.ImageAnnotatorClient()
-parser = SimpleNodeParser(chunk_size=500)
+# Per-frame relay dumps are expensive at high session counts; only print them with LOG_LEVEL=DEBUG
+DEBUG = os.getenv("LOG_LEVEL", "INFO").upper() == "DEBUG"
+
+# === Ingestion tuning ===
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", 50))
+EMBED_MAX_IN_FLIGHT = int(os.getenv("EMBED_MAX_IN_FLIGHT", 4))
+INSERT_BATCH_SIZE = int(os.getenv("INSERT_BATCH_SIZE", 100))
+BATCH_MAX_RETRIES = int(os.getenv("BATCH_MAX_RETRIES", 3))
+BATCH_RETRY_BACKOFF = float(os.getenv("BATCH_RETRY_BACKOFF", 1.0))
+SELECT_PAGE_SIZE = 1000  # PostgREST's default max rows per response
+HASH_LOOKUP_BATCH_SIZE = 100  # keeps in.(...) filters within URL limits
+
+# === Chunking ===
+# Sizes are in tokens of the splitter's tokenizer; an upload may override both
+CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", 384))
+CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", 48))
+MAX_HEADING_CHARS = int(os.getenv("MAX_HEADING_CHARS", 80))
+
+# === Query cache tuning ===
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", 1024))
+QUERY_CACHE_TTL = float(os.getenv("QUERY_CACHE_TTL", 600))
+
+# === Retrieval ===
+RETRIEVAL_BACKEND = os.getenv("RETRIEVAL_BACKEND", "supabase")  # "supabase" or "local"
+MATCH_COUNT = int(os.getenv("MATCH_COUNT", 12))  # candidates fetched; the prompt gets what fits the budget
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 1200))  # tokens of retrieved context per query
+DATA_DIR = os.getenv("DATA_DIR", "/data" if os.path.isdir("/data") else "./data")  # Render persistent disk
+LOCAL_INDEX_DIR = os.getenv("LOCAL_INDEX_DIR", os.path.join(DATA_DIR, "vector_index"))  # memory-mapped when writable
+# How query_docs answers, chosen per session via setup.answer_mode:
+#   "generate" - full llm.complete answer (default)
+#   "context"  - return the retrieved chunks; the Live model writes the answer
+#   "stream"   - stream llm tokens to the client as they arrive
+ANSWER_MODES = ("generate", "context", "stream")
+DEFAULT_ANSWER_MODE = os.getenv("DEFAULT_ANSWER_MODE", "generate")
+TOOL_CALL_TIMEOUT = float(os.getenv("TOOL_CALL_TIMEOUT", 30))
+
+# === Gemini Live upstream pool ===
+GEMINI_POOL_SIZE = int(os.getenv("GEMINI_POOL_SIZE", 2))  # warm sessions kept per answer mode; 0 disables
+GEMINI_POOL_MAX_AGE = float(os.getenv("GEMINI_POOL_MAX_AGE", 300))  # Live sessions are time-limited
+GEMINI_POOL_HEALTH_INTERVAL = float(os.getenv("GEMINI_POOL_HEALTH_INTERVAL", 30))
+
+# === Relay flow control ===
+# Frames queued per direction (~100ms of audio each). At the high watermark the
+# overflow policy applies until the queue is back down to the low watermark:
+#   "drop_oldest" - discard the stalest audio frames (control frames are kept)
+#   "block"       - stop reading from the sender, pushing back through TCP
+RELAY_QUEUE_HIGH = int(os.getenv("RELAY_QUEUE_HIGH", 50))
+RELAY_QUEUE_LOW = int(os.getenv("RELAY_QUEUE_LOW", 25))
+UPSTREAM_OVERFLOW_POLICY = os.getenv("UPSTREAM_OVERFLOW_POLICY", "drop_oldest")  # mic audio to Gemini
+DOWNSTREAM_OVERFLOW_POLICY = os.getenv("DOWNSTREAM_OVERFLOW_POLICY", "block")  # Gemini audio to client
+
+# === Server processes ===
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", 1))  # >1 forks workers sharing the port via SO_REUSEPORT
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", 60))  # seconds in-flight sessions get on shutdown
+CORPUS_VERSION_SLOTS = 4096
+INGEST_LOCK_DIR = os.getenv("INGEST_LOCK_DIR", "/tmp/doctalk-ingest-locks")
+
+# === Metrics ===
+METRICS_PATH = os.getenv("METRICS_PATH", "/metrics")  # served on the websocket port; empty disables
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))  # >0 also serves METRICS_PATH on METRICS_PORT + worker id
+TRACE_TOOL_CALLS = os.getenv("TRACE_TOOL_CALLS", "false").lower() == "true"  # or per session via setup.trace
+
+# === Transcription ===
+# Streaming Speech-to-Text of the user's audio, billed per second streamed, so off by default
+TRANSCRIBE_AUDIO = os.getenv("TRANSCRIBE_AUDIO", "false").lower() == "true"  # or per session via setup.transcribe
+SPEECH_LANGUAGE = os.getenv("SPEECH_LANGUAGE", "en-US")
+TRANSCRIBE_QUEUE_FRAMES = int(os.getenv("TRANSCRIBE_QUEUE_FRAMES", 50))  # ~5s of audio before frames are dropped
+TRANSCRIBE_STREAM_SECONDS = float(os.getenv("TRANSCRIBE_STREAM_SECONDS", 280))  # Speech ends streams at ~305s
+TRANSCRIBE_IDLE_SECONDS = float(os.getenv("TRANSCRIBE_IDLE_SECONDS", 5))  # end a stream before Speech's audio timeout
+PCM_BYTES_PER_SECOND = 32000  # 16kHz 16-bit mono from the browser
+
+# === Ingestion jobs ===
+JOB_DB_PATH = os.getenv("JOB_DB_PATH", os.path.join(DATA_DIR, "ingest_jobs.sqlite3"))
+INGEST_CONCURRENCY = int(os.getenv("INGEST_CONCURRENCY", 2))  # jobs running at once per worker process
+JOB_STALE_AFTER = float(os.getenv("JOB_STALE_AFTER", 120))  # seconds without progress before a job is reclaimed
+JOB_RECOVERY_INTERVAL = float(os.getenv("JOB_RECOVERY_INTERVAL", 30))
+
+# === Worker pools ===
+IO_POOL_WORKERS = int(os.getenv("IO_POOL_WORKERS", 16))
+CPU_POOL_WORKERS = int(os.getenv("CPU_POOL_WORKERS", os.cpu_count() or 1))
+USER_MAX_CONCURRENT_JOBS = int(os.getenv("USER_MAX_CONCURRENT_JOBS", 2))  # PDF ingestions per user
+USER_MAX_CONCURRENT_TOOL_CALLS = int(os.getenv("USER_MAX_CONCURRENT_TOOL_CALLS", 4))  # queries/deletes per user
 
-gemini_embedding_model = GeminiEmbedding(api_key=gemini_api_key, model_name="models/text-embedding-004")
-llm = Gemini(api_key=gemini_api_key, model_name="models/gemini-2.5-flash")
+# === OCR tuning ===
+OCR_ZOOM = float(os.getenv("OCR_ZOOM", 2.0))
+OCR_MAX_IN_FLIGHT = int(os.getenv("OCR_MAX_IN_FLIGHT", 8))
+PAGE_WINDOW = int(os.getenv("PAGE_WINDOW", 16))  # pages extracted/OCR'd per ingestion step
+# "auto" mode OCRs a page when it has almost no text layer, or when images cover
+# most of it and the text is sparse (chars per 1000 pt², ~3 for a full text page)
+AUTO_OCR_MIN_CHARS = int(os.getenv("AUTO_OCR_MIN_CHARS", 50))
+AUTO_OCR_IMAGE_COVERAGE = float(os.getenv("AUTO_OCR_IMAGE_COVERAGE", 0.5))
+AUTO_OCR_MIN_DENSITY = float(os.getenv("AUTO_OCR_MIN_DENSITY", 0.5))
 
+# === Clients ===
+# Built on first use in each process, never at import: with WEB_CONCURRENCY > 1
+# the workers are forked, and gRPC/HTTP clients must not cross a fork.
+def per_process(factory):
+    """Cache factory() once per process, safely across threads"""
+    lock = threading.Lock()
+    instance = {}
 
-speech_client = speech.SpeechClient()
+    @functools.wraps(factory)
+    def get():
+        pid = os.getpid()
+        if pid not in instance:
+            with lock:
+                if pid not in instance:
+                    instance.clear()
+                    instance[pid] = factory()
+        return instance[pid]
+    return get
+
+@per_process
+def get_supabase():
+    from supabase import create_client
+    return create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY)
+
+@per_process
+def get_vision_client():
+    from google.cloud import vision
+    return vision.ImageAnnotatorClient()
+
+@per_process
+def get_embedding_model():
+    from llama_index.embeddings.gemini import GeminiEmbedding
+    return GeminiEmbedding(
+        api_key=gemini_api_key,
+        model_name="models/text-embedding-004",
+        embed_batch_size=EMBED_BATCH_SIZE
+    )
+
+@per_process
+def get_llm():
+    from llama_index.llms.gemini import Gemini
+    return Gemini(api_key=gemini_api_key, model_name="models/gemini-2.5-flash")
+
+@per_process
+def get_speech_client():
+    from google.cloud import speech
+    return speech.SpeechClient()
+
+@functools.lru_cache(maxsize=8)  # pure Python, so safe to share across a fork
+def get_parser(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP):
+    from llama_index.core.node_parser import SentenceSplitter
+    return SentenceSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+
+@per_process
+def get_tokenizer():
+    from llama_index.core.utils import get_tokenizer as llama_tokenizer
+    return llama_tokenizer()
+
+def count_tokens(text):
+    return len(get_tokenizer()(text))
+
+def warm_clients():
+    """Build every client ahead of the first request; runs after the port is open"""
+    started = time.perf_counter()
+    for get_client in (get_supabase, get_embedding_model, get_llm, get_parser, get_vision_client):
+        try:
+            get_client()
+        except Exception as e:
+            print(f"⚠️ Could not initialize {get_client.__name__}: {e}")
+    print(f"🔥 Clients ready in {time.perf_counter() - started:.2f}s")
+    verify_embedding_dimension()
 
 # Verify embedding dimension on startup
 def verify_embedding_dimension():
+    global EMBEDDING_DIMENSION
     try:
-        test_embedding = gemini_embedding_model.get_text_embedding("test")
+        test_embedding = get_embedding_model().get_text_embedding("test")
         dimension = len(test_embedding)
         print(f"✅ Embedding dimension: {dimension}")
+        EMBEDDING_DIMENSION = dimension
         return dimension
     except Exception as e:
         print(f"⚠️ Warning: Could not verify embedding dimension: {e}")
         return None
 
-EMBEDDING_DIMENSION = verify_embedding_dimension()
+EMBEDDING_DIMENSION = None  # set by verify_embedding_dimension() when a worker starts
+
+# === Metrics ===
+# Latency histograms for the hot paths, rendered in Prometheus text format at
+# METRICS_PATH. Each worker process keeps its own counts: with WEB_CONCURRENCY > 1
+# every series carries a worker label, and METRICS_PORT gives each worker its
+# own scrape port, since requests to the shared port land on a random worker.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+histograms = []
+worker_id = None  # set by run_worker in forked workers
+
+def _with_worker(labels=""):
+    """Add the worker label to a rendered label set such as '{le="0.5"}'"""
+    if worker_id is None:
+        return labels
+    if not labels:
+        return f'{{worker="{worker_id}"}}'
+    return f'{{worker="{worker_id}",{labels[1:]}'
+# Set while a traced tool call runs; timed spans are collected into it
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+class Histogram:
+    """Cumulative latency histogram in seconds, safe to observe from worker threads"""
+
+    def __init__(self, name, help_text, span=None, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.span = span  # short name used in tool call traces
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+        histograms.append(self)
+
+    def observe(self, seconds):
+        with self._lock:
+            self.count += 1
+            self.sum += seconds
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    self.counts[i] += 1
+        trace = current_trace.get()
+        if trace is not None and self.span:
+            trace["spans"].append((self.span, seconds))
+
+    @contextlib.contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+    def render(self):
+        with self._lock:
+            lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+            for bound, count in zip(self.buckets, self.counts):
+                le = _with_worker(f'{{le="{bound}"}}')
+                lines.append(f"{self.name}_bucket{le} {count}")
+            le = _with_worker('{le="+Inf"}')
+            lines.append(f"{self.name}_bucket{le} {self.count}")
+            lines.append(f"{self.name}_sum{_with_worker()} {self.sum:.6f}")
+            lines.append(f"{self.name}_count{_with_worker()} {self.count}")
+        return lines
+
+embed_query_seconds = Histogram("doctalk_embed_query_seconds", "Query embedding request latency", "embed_query")
+embed_batch_seconds = Histogram("doctalk_embed_batch_seconds", "Ingestion embedding batch latency", "embed_batch")
+match_rpc_seconds = Histogram("doctalk_match_rpc_seconds", "match_document_chunks RPC latency", "match_rpc")
+llm_complete_seconds = Histogram("doctalk_llm_complete_seconds", "LLM completion latency (whole stream when streaming)", "llm_complete")
+ocr_page_seconds = Histogram("doctalk_ocr_page_seconds", "Render and Vision OCR latency per page", "ocr_page")
+insert_batch_seconds = Histogram("doctalk_insert_batch_seconds", "Supabase document_chunks insert batch latency", "insert_batch")
+relay_frame_seconds = Histogram("doctalk_relay_frame_seconds", "Relay frame latency from enqueue to websocket send")
+session_start_seconds = Histogram("doctalk_session_start_seconds", "Gemini Live session acquire latency")
+tool_call_seconds = Histogram("doctalk_tool_call_seconds", "Gemini tool call latency end to end")
+transcription_audio_seconds = Histogram(
+    "doctalk_transcription_turn_audio_seconds", "Audio seconds streamed to Speech per conversation turn"
+)
+
+def start_trace(trace_id):
+    """Collect timed spans for the current task (and run_io calls it makes) under trace_id"""
+    trace = {"id": trace_id or uuid.uuid4().hex[:12], "spans": [], "started": time.perf_counter()}
+    current_trace.set(trace)
+    return trace
+
+def finish_trace(trace):
+    total = time.perf_counter() - trace["started"]
+    spans = ", ".join(f"{name} {seconds * 1000:.0f}ms" for name, seconds in trace["spans"])
+    print(f"⏱️ Trace {trace['id']}: {spans or 'cached'} (total {total * 1000:.0f}ms)")
+    return {
+        "trace_id": trace["id"],
+        "spans": [{"name": name, "ms": round(seconds * 1000, 1)} for name, seconds in trace["spans"]],
+        "total_ms": round(total * 1000, 1),
+    }
+
+def _gauge(lines, name, help_text, samples, kind="gauge"):
+    """samples is a value or a list of (labels, value)"""
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} {kind}")
+    if not isinstance(samples, list):
+        samples = [("", samples)]
+    for labels, value in samples:
+        lines.append(f"{name}{_with_worker(labels)} {value}")
+
+def render_metrics():
+    """All metrics of this worker in Prometheus text exposition format"""
+    lines = []
+    for histogram in histograms:
+        lines.extend(histogram.render())
+    _gauge(lines, "doctalk_active_sessions", "Open client sessions", len(active_sessions))
+    _gauge(lines, "doctalk_background_jobs", "Running ingestion and tool tasks", len(background_jobs))
+    relays = list(active_relays.values())
+    _gauge(lines, "doctalk_relay_queue_depth", "Frames waiting in relay queues", [
+        (f'{{direction="{direction}"}}', sum(relay[direction].stats()["depth"] for relay in relays))
+        for direction in ("upstream", "downstream")
+    ])
+    # Process totals, so the counter doesn't fall when a session ends
+    _gauge(lines, "doctalk_relay_queue_dropped_total", "Stale audio frames dropped by relay queues", [
+        (f'{{direction="{direction}"}}', RelayQueue.dropped_total.get(direction, 0))
+        for direction in ("upstream", "downstream")
+    ], "counter")
+    caches = cache_stats()
+    for field in ("hits", "misses"):
+        _gauge(lines, f"doctalk_cache_{field}_total", f"Query cache {field}", [
+            (f'{{cache="{name}"}}', stats[field]) for name, stats in caches.items()
+        ], "counter")
+    _gauge(lines, "doctalk_gemini_pool_idle", "Pre-warmed Gemini sessions ready", gemini_pool.idle_count())
+    return "\n".join(lines) + "\n"
+
+def serve_metrics(connection, request):
+    """
+    websockets process_request hook: answer GET METRICS_PATH (Prometheus) and
+    METRICS_PATH/relays (per-session relay queue stats as JSON), let other requests upgrade
+    """
+    if not METRICS_PATH:
+        return None
+    if request.path == METRICS_PATH:
+        return connection.respond(200, render_metrics())
+    if request.path == f"{METRICS_PATH.rstrip('/')}/relays":
+        response = connection.respond(200, json.dumps(relay_metrics()) + "\n")
+        del response.headers["Content-Type"]
+        response.headers["Content-Type"] = "application/json"
+        return response
+    return None
+
+def serve_metrics_only(connection, request):
+    """process_request hook for the per-worker METRICS_PORT: never upgrades"""
+    return serve_metrics(connection, request) or connection.respond(404, "Not found\n")
+
+# === Text Extraction ===
+# Documents are opened from the in-memory download and read page by page, so
+# at most PAGE_WINDOW pages of text (and rendered images) are held at once.
+def open_pdf(pdf_bytes):
+    import fitz
+    return fitz.open(stream=pdf_bytes, filetype="pdf")
 
-# === Text Extraction (keep your existing functions) ===
-def extract_text_no_ocr(path):
+def single_page_pdf(doc, page_number):
+    """Copy one page into its own small PDF so a worker process can render it"""
+    import fitz
+    page_doc = fitz.open()
     try:
-        doc = fitz.open(path)
-        text = "".join(page.get_text() for page in doc)
+        page_doc.insert_pdf(doc, from_page=page_number, to_page=page_number)
+        return page_doc.tobytes()
+    finally:
+        page_doc.close()
+
+def render_page_png(page_pdf_bytes, zoom=OCR_ZOOM):
+    """Rasterize a single-page PDF to PNG; runs in a cpu_pool worker process"""
+    import fitz
+    doc = open_pdf(page_pdf_bytes)
+    try:
+        pix = doc[0].get_pixmap(matrix=fitz.Matrix(zoom, zoom))
+        return pix.tobytes("png")
+    finally:
         doc.close()
-        return text
+
+def ocr_page(page_number, page_pdf_bytes, fallback_text):
+    """OCR one page, falling back to its text layer if rasterizing or Vision fails"""
+    try:
+        with ocr_page_seconds.time():
+            img_bytes = get_cpu_pool().submit(render_page_png, page_pdf_bytes).result()
+            # A plain dict is marshalled into vision.Image, so only the client touches the SDK
+            response = get_vision_client().document_text_detection(image={"content": img_bytes})
+        if response.error.message:
+            raise RuntimeError(response.error.message)
+        if response.full_text_annotation:
+            return response.full_text_annotation.text
     except Exception as e:
-        print(f"Error extracting text without OCR: {e}")
-        raise
+        print(f"Error with OCR on page {page_number + 1}: {e}, falling back")
+    return fallback_text
+
+def ocr_pages(doc, page_numbers, fallback_texts):
+    """OCR pages in parallel, keeping at most OCR_MAX_IN_FLIGHT pages rendered or in Vision"""
+    # fitz documents aren't thread-safe, so pages are split out before dispatch
+    page_pdfs = [single_page_pdf(doc, page_number) for page_number in page_numbers]
+    with ThreadPoolExecutor(max_workers=OCR_MAX_IN_FLIGHT) as pool:
+        # map() yields in submission order, so page order is preserved
+        return list(pool.map(ocr_page, page_numbers, page_pdfs, fallback_texts))
+
+def page_needs_ocr(page, text):
+    """Decide from text density and image coverage whether a page needs OCR"""
+    import fitz
+    chars = len(text.strip())
+    if chars < AUTO_OCR_MIN_CHARS:
+        return True
+    page_area = page.rect.width * page.rect.height
+    if page_area <= 0:
+        return False
+    image_area = 0.0
+    for info in page.get_image_info():
+        bbox = fitz.Rect(info["bbox"]) & page.rect
+        if not bbox.is_empty:
+            image_area += bbox.width * bbox.height
+    coverage = min(image_area / page_area, 1.0)
+    density = chars / page_area * 1000
+    return coverage >= AUTO_OCR_IMAGE_COVERAGE and density < AUTO_OCR_MIN_DENSITY
 
-def extract_text_with_ocr(path):
+def iter_page_texts(pdf_bytes, ocr_mode=False, stats=None, known_pages=None):
+    """Yield each page's text in order.
+
+    ocr_mode is False (text layer only), True (OCR every page) or "auto" (OCR
+    only pages without a usable text layer). OCR'd and native page counts are
+    accumulated into stats if given. Pages in known_pages (page number -> text,
+    e.g. from an interrupted job) are yielded as-is without extracting them again.
+    """
+    if stats is None:
+        stats = {}
+    if known_pages is None:
+        known_pages = {}
+    stats.setdefault("ocr_pages", 0)
+    stats.setdefault("native_pages", 0)
+    doc = open_pdf(pdf_bytes)
     try:
-        doc = fitz.open(path)
-        full_text = ""
-        for page in doc:
-            zoom = 2.0
-            mat = fitz.Matrix(zoom, zoom)
-            pix = page.get_pixmap(matrix=mat)
-            img_bytes = pix.tobytes("png")
-            image = vision.Image(content=img_bytes)
-            response = vision_client.document_text_detection(image=image)
-            if response.full_text_annotation:
-                full_text += response.full_text_annotation.text + "\n"
+        for start in range(0, doc.page_count, PAGE_WINDOW):
+            page_numbers = range(start, min(start + PAGE_WINDOW, doc.page_count))
+            texts = [known_pages[i] if i in known_pages else doc[i].get_text() for i in page_numbers]
+            new_numbers = [i for i in page_numbers if i not in known_pages]
+            if ocr_mode == "auto":
+                ocr_numbers = [i for i in new_numbers if page_needs_ocr(doc[i], texts[i - start])]
+            elif ocr_mode:
+                ocr_numbers = new_numbers
             else:
-                full_text += page.get_text() + "\n"
+                ocr_numbers = []
+            if ocr_numbers:
+                fallbacks = [texts[i - start] for i in ocr_numbers]
+                for page_number, text in zip(ocr_numbers, ocr_pages(doc, ocr_numbers, fallbacks)):
+                    texts[page_number - start] = text
+            stats["ocr_pages"] += len(ocr_numbers)
+            stats["native_pages"] += len(new_numbers) - len(ocr_numbers)
+            yield from texts
+    finally:
         doc.close()
-        return full_text
-    except Exception as e:
-        print(f"Error with OCR: {e}, falling back")
-        return extract_text_no_ocr(path)
 
-def transcribe_audio(audio_data):
-    """Transcribe base64 PCM audio to text"""
-    try:
-        # Decode base64 to bytes
-        audio_bytes = base64.b64decode(audio_data)
-        
-        # Create speech recognition request
-        audio = speech.RecognitionAudio(content=audio_bytes)
-        config = speech.RecognitionConfig(
-            encoding=speech.RecognitionConfig.AudioEncoding.LINEAR16,
-            sample_rate_hertz=16000,
-            language_code="en-US",
-            enable_automatic_punctuation=True,
-        )
-        
-        # Transcribe
-        response = speech_client.recognize(config=config, audio=audio)
-        
-        # Extract transcript
-        if response.results:
-            return response.results[0].alternatives[0].transcript
-        return ""
-    except Exception as e:
-        print(f"Transcription error: {e}")
-        return ""
+def extract_text_no_ocr(pdf_bytes):
+    return "".join(iter_page_texts(pdf_bytes))
+
+def extract_text_with_ocr(pdf_bytes):
+    return "".join(text + "\n" for text in iter_page_texts(pdf_bytes, True))
+
+def _batched(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def _with_retries(fn, batch, label):
+    """Run fn(batch), retrying only this batch with exponential backoff"""
+    for attempt in range(1, BATCH_MAX_RETRIES + 1):
+        try:
+            return fn(batch)
+        except Exception as e:
+            if attempt == BATCH_MAX_RETRIES:
+                print(f"❌ {label} failed after {attempt} attempts: {e}")
+                raise
+            print(f"⚠️ {label} failed (attempt {attempt}/{BATCH_MAX_RETRIES}): {e}, retrying")
+            time.sleep(BATCH_RETRY_BACKOFF * 2 ** (attempt - 1))
+
+def _report_throughput(stage, count, seconds):
+    rate = count / seconds if seconds > 0 else float("inf")
+    print(f"  ⏱️ {stage}: {count} in {seconds:.2f}s ({rate:.1f}/s)")
+
+def insert_chunk_rows(rows):
+    """Write rows to document_chunks using multi-row inserts"""
+    def insert_batch(batch):
+        with insert_batch_seconds.time():
+            return get_supabase().table("document_chunks").insert(batch).execute()
+
+    for i, batch in enumerate(_batched(rows, INSERT_BATCH_SIZE)):
+        _with_retries(insert_batch, batch, f"Insert batch {i + 1}")
+
+def chunk_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def document_hash(pdf_bytes, ocr_mode, chunking=None):
+    """Hash of the PDF bytes, extraction mode and effective chunk sizes; changing any must re-index"""
+    effective = {"chunk_size": CHUNK_SIZE, "chunk_overlap": CHUNK_OVERLAP, **(chunking or {})}
+    digest = hashlib.sha256(pdf_bytes)
+    digest.update(f":{ocr_mode}:{effective['chunk_size']}:{effective['chunk_overlap']}".encode())
+    return digest.hexdigest()
+
+def get_document_hash(user_id, filename):
+    response = get_supabase().table("user_documents").select("content_hash").match({
+        "user_id": user_id, "filename": filename
+    }).execute()
+    return response.data[0].get("content_hash") if response.data else None
+
+def set_document_hash(user_id, filename, content_hash):
+    get_supabase().table("user_documents").update({"content_hash": content_hash}).match({
+        "user_id": user_id, "filename": filename
+    }).execute()
+
+def row_key(h, location):
+    """A stored row is unchanged only if both its text and its location are"""
+    return h, location.get("page_start"), location.get("page_end"), location.get("section")
+
+def fetch_existing_chunks(user_id, filename):
+    """Map row_key -> row ids for the rows currently stored for a document"""
+    existing = {}
+    start = 0
+    while True:
+        rows = get_supabase().table("document_chunks").select("id, chunk_hash, page_start, page_end, section").match({
+            "user_id": user_id, "filename": filename
+        }).range(start, start + SELECT_PAGE_SIZE - 1).execute().data
+        for row in rows:
+            existing.setdefault(row_key(row.get("chunk_hash"), row), []).append(row["id"])
+        if len(rows) < SELECT_PAGE_SIZE:
+            return existing
+        start += SELECT_PAGE_SIZE
+
+def parse_embedding(embedding):
+    if isinstance(embedding, str):  # pgvector columns come back as text
+        return json.loads(embedding)
+    return embedding
+
+def lookup_embeddings(hashes):
+    """Reuse stored embeddings for identical chunk text from any user or document"""
+    found = {}
+    for batch in _batched(list(hashes), HASH_LOOKUP_BATCH_SIZE):
+        try:
+            rows = get_supabase().table("document_chunks").select("chunk_hash, embedding").in_(
+                "chunk_hash", batch
+            ).execute().data
+        except Exception as e:
+            print(f"⚠️ Embedding lookup failed, will re-embed: {e}")
+            continue
+        for row in rows:
+            embedding = parse_embedding(row.get("embedding"))
+            if embedding:
+                found.setdefault(row["chunk_hash"], embedding)
+    return found
+
+def delete_chunk_rows(row_ids):
+    def delete_batch(batch):
+        return get_supabase().table("document_chunks").delete().in_("id", batch).execute()
+
+    for i, batch in enumerate(_batched(row_ids, HASH_LOOKUP_BATCH_SIZE)):
+        _with_retries(delete_batch, batch, f"Delete batch {i + 1}")
+
+NUMBERED_HEADING = re.compile(r"^(?:\d+(?:\.\d+)*\.?|chapter|section|article|part|appendix)\s+\w", re.IGNORECASE)
+
+def find_headings(text):
+    """(offset, heading) for each line that looks like a section heading"""
+    headings = []
+    offset = 0
+    for line in text.splitlines(keepends=True):
+        stripped = line.strip()
+        if (3 <= len(stripped) <= MAX_HEADING_CHARS
+                and not stripped.endswith((".", ",", ";", ":"))
+                and (NUMBERED_HEADING.match(stripped) or stripped.isupper())):
+            headings.append((offset, stripped))
+        offset += len(line)
+    return headings
+
+def _last_at(marks, offset, default=None):
+    """Value of the last (offset, value) mark at or before offset"""
+    value = default
+    for mark_offset, mark_value in marks:
+        if mark_offset > offset:
+            break
+        value = mark_value
+    return value
+
+def iter_chunks(pages, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP):
+    """Chunk page texts incrementally, PAGE_WINDOW pages at a time.
+
+    Yields (chunk_text, location) where location holds the 1-based page_start
+    and page_end and the section heading in effect where the chunk starts. The
+    last chunk of each window may continue on the next page, so it is carried
+    over and re-chunked with the following window.
+    """
+    from llama_index.core import Document
+    splitter = get_parser(chunk_size, chunk_overlap)
+
+    def split(pieces, section):
+        """pieces are (text, [(offset, page)]); returns [(text, page marks, location)] and the trailing section"""
+        text = ""
+        page_marks = []
+        for piece_text, piece_marks in pieces:
+            if text:
+                text += "\n"
+            page_marks.extend((len(text) + offset, page) for offset, page in piece_marks)
+            text += piece_text
+        headings = find_headings(text)
+        chunks = []
+        search_from = 0
+        for node in splitter.get_nodes_from_documents([Document(text=text)]):
+            start = node.start_char_idx
+            if start is None:
+                start = text.find(node.text[:64], search_from)
+                start = search_from if start < 0 else start
+            search_from = start
+            end = max(start, min(len(text), start + len(node.text)) - 1)
+            chunks.append((node.text, [
+                (0, _last_at(page_marks, start))
+            ] + [(offset - start, page) for offset, page in page_marks if start < offset <= end], {
+                "page_start": _last_at(page_marks, start),
+                "page_end": _last_at(page_marks, end),
+                "section": _last_at(headings, start, section),
+            }))
+        return chunks, _last_at(headings, len(text), section)
+
+    carry = None  # (text, page marks, location) of the previous window's last chunk
+    section = None  # heading in effect before the current window
+    window = []
+    for page_number, text in enumerate(pages, 1):
+        window.append((text, [(0, page_number)]))
+        if len(window) < PAGE_WINDOW:
+            continue
+        pieces = ([carry[:2]] if carry else []) + window
+        chunks, trailing_section = split(pieces, carry[2]["section"] if carry else section)
+        window = []
+        if chunks:
+            carry = chunks.pop()
+            section = carry[2]["section"]
+            for chunk_text, _, location in chunks:
+                yield chunk_text, location
+        else:
+            carry, section = None, trailing_section
+    pieces = ([carry[:2]] if carry else []) + window
+    if any(piece_text.strip() for piece_text, _ in pieces):
+        chunks, _ = split(pieces, carry[2]["section"] if carry else section)
+        for chunk_text, _, location in chunks:
+            yield chunk_text, location
+
+class EmbeddingPipeline:
+    """Embeds and stores a document's new chunks while extraction continues.
+
+    Chunks are cut into batches of EMBED_BATCH_SIZE as they arrive. Each batch
+    (embedding reuse lookup, embedding request and insert) runs on one pool kept
+    for the whole document, with at most EMBED_MAX_IN_FLIGHT batches outstanding;
+    add() only blocks while that many are still running.
+    """
+
+    def __init__(self, user_id, filename, stats, progress=None):
+        self.user_id = user_id
+        self.filename = filename
+        self.stats = stats
+        self.progress = progress
+        self._pending = []
+        self._in_flight = deque()
+        self._batches = 0
+        self._pool = ThreadPoolExecutor(max_workers=EMBED_MAX_IN_FLIGHT, thread_name_prefix="doctalk-embed")
+
+    def add(self, h, chunk_text, location):
+        self._pending.append((h, chunk_text, location))
+        if len(self._pending) >= EMBED_BATCH_SIZE:
+            self._submit()
 
-def store_chunks_and_embeddings(user_id, filename, text):
+    def finish(self):
+        """Store the remaining chunks and wait for every batch"""
+        if self._pending:
+            self._submit()
+        while self._in_flight:
+            self._collect()
+        self._pool.shutdown()
+
+    def close(self):
+        self._pool.shutdown(cancel_futures=True)
+
+    def _submit(self):
+        batch, self._pending = self._pending, []
+        while len(self._in_flight) >= EMBED_MAX_IN_FLIGHT:
+            started = time.perf_counter()
+            self._collect()
+            self.stats["wait_time"] += time.perf_counter() - started
+        self._batches += 1
+        self._in_flight.append(self._pool.submit(self._store_batch, self._batches, batch))
+        while self._in_flight and self._in_flight[0].done():
+            self._collect()
+
+    def _collect(self):
+        reused, embedded, embed_time, insert_time = self._in_flight.popleft().result()
+        self.stats["reused"] += reused
+        self.stats["embedded"] += embedded
+        self.stats["stored"] += reused + embedded
+        self.stats["embed_time"] += embed_time
+        self.stats["insert_time"] += insert_time
+        if self.progress:
+            self.progress(self.stats)
+
+    def _store_batch(self, number, batch):
+        """Embed (or reuse embeddings for) one batch of new chunks and insert their rows"""
+        reused = lookup_embeddings({h for h, _, _ in batch})
+        to_embed = [(h, t, location) for h, t, location in batch if h not in reused]
+
+        def row(h, chunk_text, location, embedding):
+            return {
+                "user_id": self.user_id,
+                "filename": self.filename,
+                "chunk": chunk_text,
+                "chunk_hash": h,
+                "embedding": embedding,
+                **location
+            }
+
+        rows = [row(h, t, location, reused[h]) for h, t, location in batch if h in reused]
+        started = time.perf_counter()
+        if to_embed:
+            with embed_batch_seconds.time():
+                embeddings = _with_retries(
+                    get_embedding_model().get_text_embedding_batch,
+                    [t for _, t, _ in to_embed], f"Embedding batch {number}"
+                )
+            rows.extend(row(h, t, location, embedding) for (h, t, location), embedding in zip(to_embed, embeddings))
+        embed_time = time.perf_counter() - started
+
+        started = time.perf_counter()
+        insert_chunk_rows(rows)
+        return len(batch) - len(to_embed), len(to_embed), embed_time, time.perf_counter() - started
+
+def store_chunks_and_embeddings(user_id, filename, pages, progress=None, chunking=None):
+    """Incrementally re-index a document from an iterable of page texts.
+
+    Pages are consumed as they are extracted and new chunks are stored in groups,
+    so memory is bounded by a window of pages. Rows whose chunk text is unchanged
+    are kept, new chunks reuse stored embeddings where the same text was embedded
+    before, and stale rows are deleted only afterwards, so queries never see the
+    document without chunks. progress(stats) is called after each stored batch;
+    chunking may override chunk_size and chunk_overlap.
+    """
     try:
-        if not text or not text.strip():
-            print(f"Warning: Empty text from {filename}")
-            return
-        doc = Document(text=text)
-        nodes = parser.get_nodes_from_documents([doc])
-        if not nodes:
+        if isinstance(pages, str):
+            pages = [pages]
+        existing = fetch_existing_chunks(user_id, filename)
+        stats = {"embed_time": 0.0, "insert_time": 0.0, "wait_time": 0.0, "reused": 0, "embedded": 0, "stored": 0}
+        total = 0
+        kept = 0
+        started = time.perf_counter()
+        pipeline = EmbeddingPipeline(user_id, filename, stats, progress)
+        try:
+            for chunk_text, location in iter_chunks(pages, **(chunking or {})):
+                total += 1
+                h = chunk_hash(chunk_text)
+                key = row_key(h, location)
+                if existing.get(key):
+                    existing[key].pop()  # unchanged chunk keeps its row
+                    kept += 1
+                    continue
+                pipeline.add(h, chunk_text, location)
+            pipeline.finish()
+        finally:
+            pipeline.close()
+        if not total:
             print(f"Warning: No chunks from {filename}")
             return
-        print(f"Processing {len(nodes)} chunks for {filename}...")
-        supabase.table("document_chunks").delete().match({
-            "user_id": user_id, "filename": filename
-        }).execute()
-        for i, node in enumerate(nodes):
-            try:
-                embedding = gemini_embedding_model.get_text_embedding(node.text)
-                supabase.table("document_chunks").insert({
-                    "user_id": user_id,
-                    "filename": filename,
-                    "chunk": node.text,
-                    "embedding": embedding
-                }).execute()
-                if i % 10 == 0:
-                    print(f"  Stored {i+1}/{len(nodes)} chunks...")
-            except Exception as e:
-                print(f"Error storing chunk {i}: {e}")
-                continue
-        print(f"✅ Successfully indexed {len(nodes)} chunks for {filename}")
+
+        stale_ids = [row_id for ids in existing.values() for row_id in ids]
+        if stale_ids:
+            delete_chunk_rows(stale_ids)
+        invalidate_user_cache(user_id)
+        retriever.corpus_changed(user_id)
+
+        elapsed = time.perf_counter() - started
+        # Embedding and inserts overlap extraction, so their times are summed across batches
+        _report_throughput("Extracted + chunked", total, elapsed - stats["wait_time"])
+        _report_throughput("Embedded chunks (per batch-second)", stats["embedded"], stats["embed_time"])
+        _report_throughput("Inserted rows (per batch-second)", stats["stored"], stats["insert_time"])
+        print(f"✅ Indexed {filename}: {kept} unchanged, {stats['reused']} reused embeddings, "
+              f"{stats['embedded']} embedded, {len(stale_ids)} stale removed")
     except Exception as e:
         print(f"Error in store_chunks_and_embeddings: {e}")
+        invalidate_user_cache(user_id)  # some batches may already be stored
         raise
 
+# === Query caches ===
+class TTLCache:
+    """Thread-safe LRU cache whose entries also expire after ttl seconds"""
+
+    def __init__(self, name, maxsize=QUERY_CACHE_SIZE, ttl=QUERY_CACHE_TTL):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def evict(self, predicate):
+        with self._lock:
+            for key in [key for key in self._data if predicate(key)]:
+                del self._data[key]
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
+
+query_embedding_cache = TTLCache("query_embedding")  # normalized query -> embedding
+retrieval_cache = TTLCache("retrieval")  # (user_id, embedding, corpus version) -> chunks
+answer_cache = TTLCache("answer")  # prompt hash -> answer
+# Corpus versions live in shared memory created before workers fork, so an upload
+# handled by one worker invalidates cached retrievals in all of them. Users are
+# hashed into slots; a collision only causes an extra cache miss.
+_corpus_versions = multiprocessing.Array("Q", CORPUS_VERSION_SLOTS)
+
+def _corpus_slot(user_id):
+    return zlib.crc32(user_id.encode()) % CORPUS_VERSION_SLOTS
+
+def corpus_version(user_id):
+    return _corpus_versions[_corpus_slot(user_id)]
+
+def invalidate_user_cache(user_id):
+    """Called whenever a user's chunks change; drops their cached retrievals"""
+    with _corpus_versions.get_lock():
+        _corpus_versions[_corpus_slot(user_id)] += 1
+    retrieval_cache.evict(lambda key: key[0] == user_id)
+
+def cache_stats():
+    return {cache.name: cache.stats() for cache in (query_embedding_cache, retrieval_cache, answer_cache)}
+
+# === Retrieval backends ===
+def format_chunk(row):
+    """Chunk text headed by its source, for rows stored with page metadata"""
+    if row.get("page_start") is None:
+        return row["chunk"]
+    if row.get("page_end") in (None, row["page_start"]):
+        pages = f"p. {row['page_start']}"
+    else:
+        pages = f"pp. {row['page_start']}-{row['page_end']}"
+    source = ", ".join(part for part in (row.get("filename"), pages, row.get("section")) if part)
+    return f"[{source}]\n{row['chunk']}"
+
+class SupabaseRetriever:
+    """Top-k search through the match_document_chunks RPC"""
+
+    def search(self, user_id, query_embedding, k=MATCH_COUNT):
+        with match_rpc_seconds.time():
+            response = get_supabase().rpc("match_document_chunks", {
+                "query_embedding": query_embedding,
+                "match_user_id": user_id,
+                "match_count": k
+            }).execute()
+        return [format_chunk(row) for row in response.data or []]
+
+    def acquire_user(self, user_id):
+        pass
+
+    def release_user(self, user_id):
+        pass
+
+    def corpus_changed(self, user_id):
+        pass
+
+
+class LocalVectorIndex:
+    """In-process cosine top-k over each active user's chunks.
+
+    Embeddings are kept as one normalized float32 matrix per user. When
+    LOCAL_INDEX_DIR is writable (the /data disk on Render) the matrix is saved
+    there and memory-mapped on the next load, as long as the user's chunk ids
+    haven't changed in the meantime.
+    """
+
+    def __init__(self, index_dir=LOCAL_INDEX_DIR):
+        self.index_dir = index_dir
+        self._users = {}  # user_id -> (ids, chunks, matrix, corpus version)
+        self._sessions = {}  # user_id -> active session count
+        self._reloading = set()
+        self._lock = threading.Lock()
+
+    def _paths(self, user_id):
+        name = hashlib.sha256(user_id.encode()).hexdigest()
+        return os.path.join(self.index_dir, f"{name}.npy"), os.path.join(self.index_dir, f"{name}.json")
+
+    def _fetch_rows(self, user_id, columns):
+        rows = []
+        while True:
+            page = get_supabase().table("document_chunks").select(columns).match({
+                "user_id": user_id
+            }).order("id").range(len(rows), len(rows) + SELECT_PAGE_SIZE - 1).execute().data
+            rows.extend(page)
+            if len(page) < SELECT_PAGE_SIZE:
+                return rows
+
+    def _load_from_disk(self, user_id, ids):
+        import numpy as np
+        matrix_path, meta_path = self._paths(user_id)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if meta["ids"] != ids:
+                return None
+            return ids, meta["chunks"], np.load(matrix_path, mmap_mode="r")
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _save_to_disk(self, user_id, ids, chunks, matrix):
+        import numpy as np
+        matrix_path, meta_path = self._paths(user_id)
+        try:
+            os.makedirs(self.index_dir, exist_ok=True)
+            np.save(matrix_path, matrix)
+            with open(meta_path, "w") as f:
+                json.dump({"ids": ids, "chunks": chunks}, f)
+        except OSError as e:
+            print(f"⚠️ Could not persist vector index: {e}")
+
+    def load_user(self, user_id):
+        """(Re)build a user's matrix, preferring the memory-mapped copy if still current"""
+        import numpy as np
+        started = time.perf_counter()
+        version = corpus_version(user_id)  # read first, so changes during the load trigger another
+        ids = [row["id"] for row in self._fetch_rows(user_id, "id")]
+        entry = self._load_from_disk(user_id, ids)
+        if entry is None:
+            rows = self._fetch_rows(user_id, "id, chunk, filename, page_start, page_end, section, embedding")
+            ids = [row["id"] for row in rows]
+            chunks = [format_chunk(row) for row in rows]
+            if rows:
+                matrix = np.asarray([parse_embedding(row["embedding"]) for row in rows], dtype=np.float32)
+                norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+                matrix /= np.where(norms == 0, 1, norms)
+            else:
+                matrix = np.zeros((0, EMBEDDING_DIMENSION or 0), dtype=np.float32)
+            self._save_to_disk(user_id, ids, chunks, matrix)
+            entry = (ids, chunks, matrix)
+        entry = (*entry, version)
+        with self._lock:
+            if user_id in self._sessions:  # swap atomically; searches keep using the old entry until now
+                self._users[user_id] = entry
+        print(f"📚 Local index for {user_id}: {len(entry[0])} chunks in {time.perf_counter() - started:.2f}s")
+
+    def acquire_user(self, user_id):
+        """Called on session start; loads the user's index if not already resident"""
+        with self._lock:
+            self._sessions[user_id] = self._sessions.get(user_id, 0) + 1
+            needs_load = user_id not in self._users
+        if needs_load:
+            self.load_user(user_id)
+
+    def release_user(self, user_id):
+        with self._lock:
+            remaining = self._sessions.get(user_id, 0) - 1
+            if remaining > 0:
+                self._sessions[user_id] = remaining
+            else:
+                self._sessions.pop(user_id, None)
+                self._users.pop(user_id, None)
+
+    def _reload(self, user_id):
+        try:
+            self.load_user(user_id)
+        except Exception as e:
+            print(f"⚠️ Local index reload failed for {user_id}: {e}")
+        finally:
+            with self._lock:
+                self._reloading.discard(user_id)
+
+    def _schedule_reload(self, user_id):
+        """Rebuild the user's index on the I/O pool unless a rebuild is already running"""
+        with self._lock:
+            reload = user_id not in self._reloading
+            self._reloading.add(user_id)
+        if reload:
+            get_io_pool().submit(self._reload, user_id)
+
+    def corpus_changed(self, user_id):
+        with self._lock:
+            active = user_id in self._sessions
+        if active:
+            self._schedule_reload(user_id)
+
+    def search(self, user_id, query_embedding, k=MATCH_COUNT):
+        import numpy as np
+        entry = self._users.get(user_id)
+        if entry is None:
+            # No session has loaded this user yet (or the lazy load is still running)
+            return SupabaseRetriever().search(user_id, query_embedding, k)
+        _, chunks, matrix, version = entry
+        if version != corpus_version(user_id):
+            # Another worker changed this user's documents; rebuild in the background
+            self._schedule_reload(user_id)
+            return SupabaseRetriever().search(user_id, query_embedding, k)
+        if not len(chunks):
+            return []
+        query = np.asarray(query_embedding, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1
+        scores = matrix @ query
+        k = min(k, len(chunks))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [chunks[i] for i in top]
+
+
+def make_retriever(name=RETRIEVAL_BACKEND):
+    if name == "local":
+        return LocalVectorIndex()
+    return SupabaseRetriever()
+
+retriever = make_retriever()
+
 def delete_document(user_id, filename):
     try:
         print(f"🗑️ Deleting {filename}")
-        supabase.table("document_chunks").delete().match({
+        get_supabase().table("document_chunks").delete().match({
             "user_id": user_id, "filename": filename
         }).execute()
-        supabase.table("user_documents").delete().match({
+        invalidate_user_cache(user_id)
+        retriever.corpus_changed(user_id)
+        get_supabase().table("user_documents").delete().match({
             "user_id": user_id, "filename": filename
         }).execute()
         storage_path = f"{user_id}/{filename}"
-        supabase.storage.from_("pdfs").remove([storage_path])
+        get_supabase().storage.from_("pdfs").remove([storage_path])
         print(f"✅ Deleted {filename}")
         return f"Deleted {filename}"
     except Exception as e:
         print(f"❌ Error deleting: {e}")
         return str(e)
 
-def query_docs(query, user_id):
+def embed_query(query):
+    key = " ".join(query.lower().split())
+    embedding = query_embedding_cache.get(key)
+    if embedding is None:
+        with embed_query_seconds.time():
+            embedding = get_embedding_model().get_text_embedding(query)
+        query_embedding_cache.set(key, embedding)
+    return embedding
+
+def retrieve_chunks(user_id, query_embedding):
+    key = (user_id, hash(tuple(query_embedding)), corpus_version(user_id))
+    chunks = retrieval_cache.get(key)
+    if chunks is None:
+        chunks = retriever.search(user_id, query_embedding)
+        retrieval_cache.set(key, chunks)
+    return chunks
+
+def pack_context(chunks, budget=CONTEXT_TOKEN_BUDGET):
+    """Keep chunks in relevance order while they fit the token budget (always at least one)"""
+    packed = []
+    used = 0
+    for chunk in chunks:
+        tokens = count_tokens(chunk)
+        if packed and used + tokens > budget:
+            continue  # a shorter, less relevant chunk may still fit
+        packed.append(chunk)
+        used += tokens
+    return packed, used
+
+def complete(prompt):
+    key = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+    answer = answer_cache.get(key)
+    if answer is None:
+        with llm_complete_seconds.time():
+            answer = str(get_llm().complete(prompt))
+        answer_cache.set(key, answer)
+    return answer
+
+class ToolCallCancelled(Exception):
+    """Raised in a worker thread once its tool call was cancelled or timed out"""
+
+def check_cancelled(cancelled):
+    if cancelled is not None and cancelled.is_set():
+        raise ToolCallCancelled()
+
+def stream_complete(prompt, on_token, cancelled=None):
+    """Like complete(), but hands each token to on_token as it is generated"""
+    key = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+    answer = answer_cache.get(key)
+    if answer is not None:
+        on_token(answer)
+        return answer
+    deltas = []
+    with llm_complete_seconds.time():
+        for response in get_llm().stream_complete(prompt):
+            check_cancelled(cancelled)  # leaving the loop closes the stream
+            if response.delta:
+                deltas.append(response.delta)
+                on_token(response.delta)
+    answer = "".join(deltas)
+    answer_cache.set(key, answer)
+    return answer
+
+def query_docs(query, user_id, answer_mode="generate", on_token=None, cancelled=None):
+    """cancelled is a threading.Event checked between the embedding, retrieval and LLM steps"""
     try:
         print(f"🔍 Query: {query}")
-        query_embedding = gemini_embedding_model.get_text_embedding(query)
-        response = supabase.rpc("match_document_chunks", {
-            "query_embedding": query_embedding,
-            "match_user_id": user_id,
-            "match_count": 5
-        }).execute()
-        if not response.data:
+        query_embedding = embed_query(query)
+        check_cancelled(cancelled)
+        candidates = retrieve_chunks(user_id, query_embedding)
+        if not candidates:
             return "No relevant documents found."
-        chunks = [row["chunk"] for row in response.data]
+        chunks, tokens = pack_context(candidates)
         context = "\n\n".join(chunks)
-        print(f"  Found {len(chunks)} chunks")
-        answer = llm.complete(f"Context:\n{context}\n\nQuestion: {query}\nAnswer:")
-        return str(answer)
+        print(f"  Packed {len(chunks)}/{len(candidates)} chunks, {tokens} tokens (cache: {cache_stats()})")
+        if answer_mode == "context":
+            return context
+        check_cancelled(cancelled)
+        prompt = f"Context:\n{context}\n\nQuestion: {query}\nAnswer:"
+        if answer_mode == "stream" and on_token:
+            return stream_complete(prompt, on_token, cancelled)
+        return complete(prompt)
+    except ToolCallCancelled:
+        print(f"🚫 Query cancelled: {query}")
+        raise
     except Exception as e:
         print(f"❌ Query error: {e}")
         return f"Error: {str(e)}"
 
+# === Async execution layer ===
+# Supabase, Vision and Gemini calls are blocking, so they run on io_pool;
+# Ingestion runs on the I/O pool and OCR page rendering on the CPU pool. The event loop only relays frames.
+@per_process
+def get_io_pool():
+    return ThreadPoolExecutor(max_workers=IO_POOL_WORKERS, thread_name_prefix="doctalk-io")
+
+@per_process
+def get_cpu_pool():
+    # forkserver, not fork: by now this process holds gRPC clients and threads
+    return ProcessPoolExecutor(max_workers=CPU_POOL_WORKERS, mp_context=multiprocessing.get_context("forkserver"))
+
+_user_slots = {}
+
+async def run_io(fn, *args, **kwargs):
+    """Run a blocking I/O-bound call on the thread pool"""
+    loop = asyncio.get_running_loop()
+    # Carry context variables (the current trace) into the worker thread
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(get_io_pool(), functools.partial(context.run, fn, *args, **kwargs))
+
+def user_slot(user_id, kind="tool"):
+    """Semaphore limiting how many tool calls ("tool") or ingestions ("ingest") one user runs at once.
+
+    The two are limited separately so long indexing runs never hold up voice queries.
+    """
+    slot = _user_slots.get((kind, user_id))
+    if slot is None:
+        limit = USER_MAX_CONCURRENT_JOBS if kind == "ingest" else USER_MAX_CONCURRENT_TOOL_CALLS
+        slot = _user_slots[(kind, user_id)] = asyncio.Semaphore(limit)
+    return slot
+
+async def query_docs_async(query, user_id, answer_mode="generate", on_token=None, cancelled=None):
+    """on_token, if given, is a coroutine function awaited in order for each streamed token"""
+    async with user_slot(user_id):
+        if on_token is None:
+            return await run_io(query_docs, query, user_id, answer_mode, cancelled=cancelled)
+
+        loop = asyncio.get_running_loop()
+        tokens = asyncio.Queue()
+
+        async def forward_tokens():
+            while (delta := await tokens.get()) is not None:
+                await on_token(delta)
+
+        forwarder = asyncio.create_task(forward_tokens())
+        try:
+            return await run_io(
+                query_docs, query, user_id, answer_mode,
+                lambda delta: loop.call_soon_threadsafe(tokens.put_nowait, delta),
+                cancelled
+            )
+        finally:
+            loop.call_soon_threadsafe(tokens.put_nowait, None)  # after any queued tokens
+            await asyncio.gather(forwarder, return_exceptions=True)
+
+async def delete_document_async(user_id, filename):
+    async with user_slot(user_id):
+        return await run_io(delete_document, user_id, filename)
+
 # Tool declarations for Gemini
+SYSTEM_INSTRUCTIONS = {
+    "generate": "You MUST use query_docs for all answers.",
+    "stream": "You MUST use query_docs for all answers.",
+    "context": (
+        "You MUST use query_docs for all answers. It returns raw excerpts from the "
+        "user's documents; answer the question using only those excerpts."
+    ),
+}
+
 tool_query_docs = {
     "function_declarations": [{
         "name": "query_docs",
@@ -200,6 +1240,371 @@ tool_delete_doc = {
     }]
 }
 
+# === Audio relay fast path ===
+# The browser serializes audio frames with a fixed key order, so a prefix check is
+# enough to recognize them and forward the original string without re-encoding.
+AUDIO_FRAME_PREFIX = '{"realtime_input":{"media_chunks":[{"mime_type":"audio/pcm"'
+
+def upstream_audio_frame(message):
+    """Gemini frame for a client audio message, or None if it needs full handling.
+
+    Binary client frames are raw PCM and are wrapped here; Gemini only takes JSON.
+    """
+    if isinstance(message, bytes):
+        return ('{"realtime_input":{"media_chunks":[{"mime_type":"audio/pcm","data":"'
+                + base64.b64encode(message).decode("ascii") + '"}]}}')
+    if message.startswith(AUDIO_FRAME_PREFIX):
+        return message
+    return None
+
+def audio_frame_b64(message):
+    """The base64 PCM of a fast-path JSON audio frame, sliced out without parsing"""
+    start = message.index('"data":"') + 8
+    return message[start:message.index('"', start)]
+
+def client_audio_frame(b64_data, binary_audio):
+    """Client frame for a Gemini audio part: raw PCM bytes, or JSON without a dumps call"""
+    if binary_audio:
+        return base64.b64decode(b64_data)
+    return '{"audio":"' + b64_data + '"}'  # base64 never needs JSON escaping
+
+# === Gemini Live upstream ===
+GEMINI_URI = f"wss://generativelanguage.googleapis.com/ws/google.ai.generativelanguage.v1beta.GenerativeService.BidiGenerateContent?key={gemini_api_key}"
+
+def gemini_setup_message(answer_mode):
+    return {
+        "setup": {
+            "model": MODEL,
+            "system_instruction": {
+                "parts": [{"text": SYSTEM_INSTRUCTIONS[answer_mode]}]
+            },
+            "tools": [tool_query_docs, tool_delete_doc]
+        }
+    }
+
+async def open_gemini_session(answer_mode):
+    """Connect to the Live API and complete the setup handshake"""
+    gemini_ws = await websockets.connect(
+        GEMINI_URI,
+        additional_headers={"Content-Type": "application/json"}
+    )
+    try:
+        await gemini_ws.send(json.dumps(gemini_setup_message(answer_mode)))
+        await gemini_ws.recv()  # setup response
+    except BaseException:
+        await gemini_ws.close()
+        raise
+    return gemini_ws
+
+def percentile(samples, q):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+class GeminiSessionPool:
+    """Keeps up to `size` set-up Live sessions per answer mode ready for new clients.
+
+    Sessions are handed out once; the pool refills in the background and a
+    health loop pings idle sessions and retires any older than max_age.
+    """
+
+    def __init__(self, size=GEMINI_POOL_SIZE, max_age=GEMINI_POOL_MAX_AGE):
+        self.size = size
+        self.max_age = max_age
+        self._idle = {}  # answer_mode -> deque of (websocket, opened_at)
+        self._opening = {}  # answer_mode -> sessions being opened
+        self._tasks = set()
+        self.start_latencies = {"warm": deque(maxlen=1000), "cold": deque(maxlen=1000)}
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _healthy(self, gemini_ws, opened_at):
+        return gemini_ws.close_code is None and time.monotonic() - opened_at < self.max_age
+
+    async def _open_idle(self, answer_mode):
+        try:
+            gemini_ws = await open_gemini_session(answer_mode)
+            self._idle.setdefault(answer_mode, deque()).append((gemini_ws, time.monotonic()))
+        except Exception as e:
+            print(f"⚠️ Could not pre-warm Gemini session: {e}")
+        finally:
+            self._opening[answer_mode] -= 1
+
+    def refill(self, answer_mode):
+        if self.size <= 0:
+            return
+        idle = self._idle.setdefault(answer_mode, deque())
+        missing = self.size - len(idle) - self._opening.get(answer_mode, 0)
+        for _ in range(missing):
+            self._opening[answer_mode] = self._opening.get(answer_mode, 0) + 1
+            self._spawn(self._open_idle(answer_mode))
+
+    async def acquire(self, answer_mode):
+        """Return (websocket, "warm" | "cold"), opening a new session if none is ready"""
+        started = time.perf_counter()
+        idle = self._idle.setdefault(answer_mode, deque())
+        gemini_ws = None
+        while idle:
+            candidate, opened_at = idle.popleft()
+            if self._healthy(candidate, opened_at):
+                gemini_ws = candidate
+                break
+            self._spawn(candidate.close())
+        kind = "warm" if gemini_ws else "cold"
+        self.refill(answer_mode)
+        if gemini_ws is None:
+            gemini_ws = await open_gemini_session(answer_mode)
+        self.start_latencies[kind].append(time.perf_counter() - started)
+        session_start_seconds.observe(time.perf_counter() - started)
+        return gemini_ws, kind
+
+    def idle_count(self):
+        return sum(len(idle) for idle in self._idle.values())
+
+    async def _health_check_loop(self):
+        while True:
+            await asyncio.sleep(GEMINI_POOL_HEALTH_INTERVAL)
+            for answer_mode, idle in list(self._idle.items()):
+                for entry in list(idle):
+                    gemini_ws, opened_at = entry
+                    healthy = self._healthy(gemini_ws, opened_at)
+                    if healthy:
+                        try:
+                            await asyncio.wait_for(await gemini_ws.ping(), 5)
+                        except Exception:
+                            healthy = False
+                    if not healthy and entry in idle:  # may have been handed out meanwhile
+                        idle.remove(entry)
+                        self._spawn(gemini_ws.close())
+                self.refill(answer_mode)
+
+    def start(self, answer_modes=(DEFAULT_ANSWER_MODE,)):
+        if self.size <= 0:
+            return
+        for answer_mode in answer_modes:
+            self.refill(answer_mode)
+        self._spawn(self._health_check_loop())
+
+    async def close(self):
+        """Stop refilling and health checks and close every idle session"""
+        self.size = 0
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        idle = [gemini_ws for sessions in self._idle.values() for gemini_ws, _ in sessions]
+        self._idle.clear()
+        await asyncio.gather(*(gemini_ws.close() for gemini_ws in idle), return_exceptions=True)
+
+    def stats(self):
+        """Session-start latency percentiles in ms for warm (pooled) and cold starts"""
+        return {
+            kind: {
+                "count": len(samples),
+                "p50": percentile(samples, 0.5) * 1000,
+                "p95": percentile(samples, 0.95) * 1000,
+                "p99": percentile(samples, 0.99) * 1000,
+            }
+            for kind, samples in self.start_latencies.items()
+        }
+
+gemini_pool = GeminiSessionPool()
+
+active_sessions = set()  # session handler tasks, awaited on shutdown
+background_jobs = set()  # ingestion/tool tasks; holds references and is awaited on shutdown
+user_sockets = {}  # user_id -> client websockets on this worker, for job progress
+
+def run_in_background(coro):
+    task = asyncio.create_task(coro)
+    background_jobs.add(task)
+    task.add_done_callback(background_jobs.discard)
+    return task
+
+# === Transcription ===
+class StreamingTranscriber:
+    """One long-lived Speech streaming_recognize per session, fed from the relay.
+
+    feed() never blocks the relay: frames go into a bounded queue drained by a
+    dedicated thread and are dropped if the recognizer falls behind. Streams are
+    opened on the first frame after a pause and ended after TRANSCRIBE_IDLE_SECONDS
+    without audio or before Speech's per-stream limit. on_result(text, is_final)
+    is called on that thread.
+    """
+
+    def __init__(self, on_result, language=SPEECH_LANGUAGE):
+        self.on_result = on_result
+        self.language = language
+        self.streams = 0
+        self._frames = queue.Queue(maxsize=TRANSCRIBE_QUEUE_FRAMES)
+        self._closed = threading.Event()
+        self._usage_lock = threading.Lock()
+        self._usage = self._new_usage()
+        self._thread = threading.Thread(target=self._run, name="doctalk-transcribe", daemon=True)
+
+    @staticmethod
+    def _new_usage():
+        return {"audio_seconds": 0.0, "results": 0, "dropped": 0}
+
+    def start(self):
+        self._thread.start()
+
+    def feed(self, audio):
+        """audio is raw PCM bytes or base64 PCM; decoding happens on the worker thread"""
+        try:
+            self._frames.put_nowait(audio)
+        except queue.Full:
+            with self._usage_lock:
+                self._usage["dropped"] += 1
+
+    def close(self):
+        self._closed.set()
+        try:
+            self._frames.put_nowait(None)  # ends the current stream's request generator
+        except queue.Full:
+            pass
+
+    def end_turn(self):
+        """Usage since the previous turn: audio seconds streamed, results received and frames dropped"""
+        with self._usage_lock:
+            usage, self._usage = self._usage, self._new_usage()
+        transcription_audio_seconds.observe(usage["audio_seconds"])
+        return usage
+
+    def _next_frame(self, timeout=None):
+        """Block for the next frame; None once closed, or after timeout seconds without audio"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self._closed.is_set():
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            try:
+                return self._frames.get(timeout=0.5)
+            except queue.Empty:
+                continue
+        return None
+
+    def _requests(self, audio):
+        from google.cloud import speech
+        deadline = time.monotonic() + TRANSCRIBE_STREAM_SECONDS
+        while audio is not None:
+            pcm = audio if isinstance(audio, bytes) else base64.b64decode(audio)
+            with self._usage_lock:
+                self._usage["audio_seconds"] += len(pcm) / PCM_BYTES_PER_SECOND
+            yield speech.StreamingRecognizeRequest(audio_content=pcm)
+            if time.monotonic() >= deadline:
+                return
+            audio = self._next_frame(TRANSCRIBE_IDLE_SECONDS)
+
+    def _run(self):
+        from google.cloud import speech
+        config = speech.StreamingRecognitionConfig(
+            config=speech.RecognitionConfig(
+                encoding=speech.RecognitionConfig.AudioEncoding.LINEAR16,
+                sample_rate_hertz=16000,
+                language_code=self.language,
+                enable_automatic_punctuation=True,
+            ),
+            interim_results=True,
+        )
+        while not self._closed.is_set():
+            # Only open a stream once there is audio; Speech times out idle streams
+            first = self._next_frame()
+            if first is None:
+                break
+            self.streams += 1
+            try:
+                responses = get_speech_client().streaming_recognize(config=config, requests=self._requests(first))
+                for response in responses:
+                    for result in response.results:
+                        if not result.alternatives or self._closed.is_set():
+                            continue
+                        with self._usage_lock:
+                            self._usage["results"] += 1
+                        self.on_result(result.alternatives[0].transcript, result.is_final)
+            except Exception as e:
+                if self._closed.is_set():
+                    break
+                print(f"⚠️ Transcription stream error: {e}, restarting")
+                self._closed.wait(1.0)
+
+# === Relay flow control ===
+class RelayQueue:
+    """Bounded frame queue between one side's reader and the other side's writer"""
+
+    dropped_total = {}  # queue name -> frames dropped by every queue in this process
+
+    def __init__(self, name, high=RELAY_QUEUE_HIGH, low=RELAY_QUEUE_LOW, policy="block"):
+        self.name = name
+        self.high = high
+        self.low = min(low, high)
+        self.policy = policy
+        self.dropped = 0
+        self.max_depth = 0
+        self.blocked_seconds = 0.0
+        self._frames = deque()  # (frame, is_audio, queued_at)
+        self._not_empty = asyncio.Event()
+        self._drained = asyncio.Event()
+        self._drained.set()
+
+    def _drop_stale_audio(self):
+        excess = len(self._frames) - self.low
+        kept = deque()
+        for entry in self._frames:
+            if entry[1] and excess > 0:
+                excess -= 1
+                self.dropped += 1
+                RelayQueue.dropped_total[self.name] = RelayQueue.dropped_total.get(self.name, 0) + 1
+                continue
+            kept.append(entry)
+        self._frames = kept
+
+    async def put(self, frame, is_audio=True):
+        if len(self._frames) >= self.high and self.policy == "drop_oldest":
+            self._drop_stale_audio()
+        if len(self._frames) >= self.high:
+            # "block" policy, or nothing left that may be dropped
+            self._drained.clear()
+            started = time.perf_counter()
+            await self._drained.wait()
+            self.blocked_seconds += time.perf_counter() - started
+        self._frames.append((frame, is_audio, time.perf_counter()))
+        self.max_depth = max(self.max_depth, len(self._frames))
+        self._not_empty.set()
+
+    async def get(self):
+        """Return (frame, queued_at) for the oldest frame"""
+        while not self._frames:
+            self._not_empty.clear()
+            await self._not_empty.wait()
+        frame, _, queued_at = self._frames.popleft()
+        if len(self._frames) <= self.low:
+            self._drained.set()
+        return frame, queued_at
+
+    def stats(self):
+        return {
+            "depth": len(self._frames),
+            "max_depth": self.max_depth,
+            "dropped": self.dropped,
+            "blocked_seconds": round(self.blocked_seconds, 3),
+        }
+
+active_relays = {}  # session id -> {"user_id", "upstream", "downstream"}
+
+def relay_metrics():
+    """Per-session queue depth and drop counters"""
+    return {
+        session_id: {
+            "user_id": relay["user_id"],
+            "upstream": relay["upstream"].stats(),
+            "downstream": relay["downstream"].stats(),
+        }
+        for session_id, relay in list(active_relays.items())
+    }
+
 async def gemini_session_handler(client_websocket):
     """
     Handle a WebSocket connection from the frontend client.
@@ -207,6 +1612,11 @@ async def gemini_session_handler(client_websocket):
     """
     gemini_ws = None
     user_id = None
+    retriever_load = None
+    transcriber = None
+    pending_tool_calls = {}  # Gemini call id -> (task, threading.Event)
+    session_id = id(client_websocket)
+    active_sessions.add(asyncio.current_task())
     
     try:
         print("🔌 New client connection")
@@ -215,48 +1625,155 @@ async def gemini_session_handler(client_websocket):
         config_message = await client_websocket.recv()
         config_data = json.loads(config_message)
         user_id = config_data.get("setup", {}).get("user_id")
+        answer_mode = config_data.get("setup", {}).get("answer_mode", DEFAULT_ANSWER_MODE)
+        # Clients that opt in get Gemini audio as binary PCM frames instead of base64 JSON
+        binary_audio = bool(config_data.get("setup", {}).get("binary_audio", False))
+        # Traced tool calls report per-stage timings back to the client as tool_trace
+        trace_tool_calls = TRACE_TOOL_CALLS or bool(config_data.get("setup", {}).get("trace", False))
+        transcribe = TRANSCRIBE_AUDIO or bool(config_data.get("setup", {}).get("transcribe", False))
         
         if not user_id:
             await client_websocket.send(json.dumps({"text": "❌ user_id required"}))
             return
+        if answer_mode not in ANSWER_MODES:
+            await client_websocket.send(json.dumps({"text": f"❌ answer_mode must be one of {', '.join(ANSWER_MODES)}"}))
+            return
         
-        print(f"👤 User: {user_id}")
-        
-        # 2. Connect to Gemini Live API
-        gemini_uri = f"wss://generativelanguage.googleapis.com/ws/google.ai.generativelanguage.v1beta.GenerativeService.BidiGenerateContent?key={gemini_api_key}"
+        print(f"👤 User: {user_id} (answer mode: {answer_mode})")
         
-        gemini_ws = await websockets.connect(
-            gemini_uri,
-            additional_headers={"Content-Type": "application/json"}
-        )
-        print("✅ Connected to Gemini Live API")
+        user_sockets.setdefault(user_id, set()).add(client_websocket)
         
-        # 3. Send setup to Gemini
-        gemini_setup = {
-            "setup": {
-                "model": MODEL,
-                "system_instruction": {
-                    "parts": [{"text": "You MUST use query_docs for all answers."}]
-                },
-                "tools": [tool_query_docs, tool_delete_doc]
-            }
-        }
-        await gemini_ws.send(json.dumps(gemini_setup))
+        # Warm the retrieval backend for this user while Gemini connects
+        retriever_load = asyncio.create_task(run_io(retriever.acquire_user, user_id))
         
-        # 4. Wait for setup response
-        setup_response = await gemini_ws.recv()
-        print("✅ Gemini setup complete")
+        # 2. Attach to a warm Gemini Live session (or open one)
+        gemini_ws, start_kind = await gemini_pool.acquire(answer_mode)
+        print(f"✅ Gemini session ready ({start_kind})")
         
         user_transcript = ""
-        transcription_chunks = []  # ← MOVED INSIDE the handler function
+        transcription_chunks = []  # final transcript segments of the current turn
+        
+        # Bounded queues between the two sides instead of unbounded websocket buffers
+        upstream = RelayQueue("upstream", policy=UPSTREAM_OVERFLOW_POLICY)
+        downstream = RelayQueue("downstream", policy=DOWNSTREAM_OVERFLOW_POLICY)
+        active_relays[session_id] = {"user_id": user_id, "upstream": upstream, "downstream": downstream}
+        
+        # Recognizer results cross from the transcriber thread through this queue
+        transcripts = asyncio.Queue()
+        if transcribe:
+            loop = asyncio.get_running_loop()
+            transcriber = StreamingTranscriber(
+                lambda text, is_final: loop.call_soon_threadsafe(transcripts.put_nowait, (text, is_final))
+            )
+            transcriber.start()
+        def cancel_tool_call(call_id):
+            entry = pending_tool_calls.pop(call_id, None)
+            if entry:
+                task, cancelled = entry
+                cancelled.set()  # stops the worker thread at its next checkpoint
+                task.cancel()
+
+        async def execute_function_call(fc, cancelled):
+            name = fc.get("name")
+            args = fc.get("args", {})
+            call_id = fc.get("id")
+            
+            if name == "query_docs":
+                # Send the user's query to frontend BEFORE the AI response
+                await client_websocket.send(json.dumps({
+                    "user_query": args["query"],  # Send the interpreted query
+                    "query_from_tool": True
+                }))
+                
+                async def send_delta(delta):
+                    await client_websocket.send(json.dumps({"answer_delta": delta}))
+                
+                result = await query_docs_async(
+                    args["query"], user_id, answer_mode,
+                    send_delta if answer_mode == "stream" else None,
+                    cancelled
+                )
+                if answer_mode == "stream":
+                    await client_websocket.send(json.dumps({"answer_done": True}))
+                print("Function executed")
+                return {"name": name, "response": {"result": result}, "id": call_id}
+            
+            elif name == "delete_document":
+                try:
+                    result = await delete_document_async(user_id, args.get("filename", ""))
+                    print("✅ delete_document executed")
+                    return {"name": name, "response": {"result": result}, "id": call_id}
+                except Exception as e:
+                    print(f"❌ delete_document error: {e}")
+                    return {"name": name, "response": {"error": str(e)}, "id": call_id}
+
+        async def call_with_timeout(fc, cancelled):
+            # Runs in its own task, so the trace only covers this call
+            trace = start_trace(fc.get("id")) if trace_tool_calls else None
+            try:
+                with tool_call_seconds.time():
+                    return await asyncio.wait_for(execute_function_call(fc, cancelled), TOOL_CALL_TIMEOUT)
+            except asyncio.TimeoutError:
+                cancelled.set()
+                print(f"⏱️ {fc.get('name')} timed out after {TOOL_CALL_TIMEOUT:.0f}s")
+                return {
+                    "name": fc.get("name"),
+                    "response": {"error": f"Timed out after {TOOL_CALL_TIMEOUT:.0f}s"},
+                    "id": fc.get("id")
+                }
+            finally:
+                if trace:
+                    summary = finish_trace(trace)
+                    try:
+                        await client_websocket.send(json.dumps({"tool_trace": {"name": fc.get("name"), **summary}}))
+                    except websockets.exceptions.ConnectionClosed:
+                        pass
+
+        async def handle_tool_call(function_calls):
+            """Run a toolCall's function calls concurrently and reply in call order"""
+            tasks = []
+            for fc in function_calls:
+                cancelled = threading.Event()
+                task = asyncio.create_task(call_with_timeout(fc, cancelled))
+                if fc.get("id"):
+                    pending_tool_calls[fc["id"]] = (task, cancelled)
+                tasks.append(task)
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+            
+            function_responses = []
+            for fc, result in zip(function_calls, results):
+                pending_tool_calls.pop(fc.get("id"), None)
+                if isinstance(result, dict):
+                    function_responses.append(result)
+                elif isinstance(result, asyncio.CancelledError):
+                    print(f"🚫 {fc.get('name')} cancelled")
+                elif isinstance(result, BaseException):
+                    print(f"Error executing function: {result}")
+            
+            # Send function responses back to Gemini
+            if function_responses:
+                try:
+                    await gemini_ws.send(json.dumps({
+                        "tool_response": {"function_responses": function_responses}
+                    }))
+                except websockets.exceptions.ConnectionClosed:
+                    print("🔌 Gemini disconnected before tool response")
 
         # 5. Create bidirectional message relay
         async def client_to_gemini():
             """Forward messages from client to Gemini"""
-            nonlocal transcription_chunks  # ← Allow modification of outer variable
-            
             try:
                 async for message in client_websocket:
+                    # Audio goes straight through; only control messages are parsed
+                    audio_frame = upstream_audio_frame(message)
+                    if audio_frame is not None:
+                        if DEBUG:
+                            print(f"🎤 Audio chunk ({len(message)} bytes)")
+                        await upstream.put(audio_frame)
+                        if transcriber:
+                            transcriber.feed(message if isinstance(message, bytes) else audio_frame_b64(message))
+                        continue
+                    
                     data = json.loads(message)
                     
                     # Handle direct tool calls from client (delete operations)
@@ -264,15 +1781,7 @@ async def gemini_session_handler(client_websocket):
                         tool_call = data["realtime_input"]["tool_call"]
                         if "function_calls" in tool_call:
                             for call in tool_call["function_calls"]:
-                                fn = call.get("name")
-                                args = call.get("args", {})
-                                
-                                if fn == "delete_document":
-                                    result = delete_document(user_id, args.get("filename", ""))
-                                    await client_websocket.send(json.dumps({"text": f"✅ {result}"}))
-                                elif fn == "query_docs":
-                                    result = query_docs(args.get("query", ""), user_id)
-                                    await client_websocket.send(json.dumps({"text": f"🔍 {result}"}))
+                                run_in_background(handle_client_tool_call(client_websocket, user_id, call))
                         continue
                     
                     # Handle PDF uploads (don't send to Gemini)
@@ -280,33 +1789,39 @@ async def gemini_session_handler(client_websocket):
                         chunks = data["realtime_input"].get("media_chunks", [])
                         for chunk in chunks:
                             if chunk.get("mime_type") == "application/pdf":
-                                # Process PDF locally
-                                await process_pdf(client_websocket, user_id, chunk)
+                                # Process PDF locally without holding up this session's audio
+                                run_in_background(process_pdf(client_websocket, user_id, chunk))
                                 continue
                             
                             # Handle audio
                             if chunk.get("mime_type") == "audio/pcm":
-                                print(f"🎤 Audio chunk ({len(chunk.get('data', ''))} bytes)")
-                                
-                                # Comment out transcription calls
-                                # transcript = transcribe_audio(chunk.get('data', ''))
-                                # if transcript:
-                                #     transcription_chunks.append(transcript)
-                                #     user_transcript = " ".join(transcription_chunks)
-                                    
-                                #     # Send partial transcription to frontend
-                                #     await client_websocket.send(json.dumps({
-                                #         "user_transcript": user_transcript,
-                                #         "transcript_partial": True
-                                #     }))
+                                if DEBUG:
+                                    print(f"🎤 Audio chunk ({len(chunk.get('data', ''))} bytes)")
                                 
                                 # Forward audio to Gemini
-                                await gemini_ws.send(json.dumps(data))
+                                await upstream.put(json.dumps(data))
+                                if transcriber:
+                                    transcriber.feed(chunk.get("data", ""))
             except websockets.exceptions.ConnectionClosed:
                 print("🔌 Client disconnected")
             except Exception as e:
                 print(f"❌ client_to_gemini error: {e}")
         
+        async def forward_transcripts():
+            """Send the current turn's transcript to the client as results arrive"""
+            nonlocal user_transcript
+            while True:
+                text, is_final = await transcripts.get()
+                if is_final:
+                    transcription_chunks.append(text.strip())
+                    user_transcript = " ".join(transcription_chunks)
+                else:
+                    user_transcript = " ".join(transcription_chunks + [text.strip()])
+                await downstream.put(json.dumps({
+                    "user_transcript": user_transcript,
+                    "transcript_partial": not is_final
+                }), is_audio=False)
+        
         async def gemini_to_client():
             """Forward messages from Gemini to client"""
             nonlocal transcription_chunks  # ← Allow modification of outer variable
@@ -315,84 +1830,46 @@ async def gemini_session_handler(client_websocket):
                 async for raw_response in gemini_ws:
                     response = json.loads(raw_response)
                     
-                    print(f"🔍 Full response: {json.dumps(response, indent=2, default=str)[:500]}...")
+                    if DEBUG:
+                        print(f"🔍 Full response: {json.dumps(response, indent=2, default=str)[:500]}...")
 
-                    # Handle tool calls from Gemini
+                    # Handle tool calls from Gemini without pausing the relay
                     if "toolCall" in response:
                         print("🔧 Tool call from Gemini")
                         function_calls = response["toolCall"].get("functionCalls", [])
-                        function_responses = []
-                        
-                        for fc in function_calls:
-                            name = fc.get("name")
-                            args = fc.get("args", {})
-                            call_id = fc.get("id")
-                            
-                            if name == "query_docs":
-                                try:
-                                    result = query_docs(args["query"], user_id)
-                                    
-                                    # Send the user's query to frontend BEFORE the AI response
-                                    await client_websocket.send(json.dumps({
-                                        "user_query": args["query"],  # Send the interpreted query
-                                        "query_from_tool": True
-                                    }))
-                                    
-                                    function_responses.append({
-                                        "name": name,
-                                        "response": {"result": result},
-                                        "id": call_id  
-                                    })
-                                    
-                                    print("Function executed")
-                                except Exception as e:
-                                    print(f"Error executing function: {e}")
-                                    continue
-                            
-                            elif name == "delete_document":
-                                try:
-                                    result = delete_document(user_id, args.get("filename", ""))
-                                    function_responses.append({
-                                        "name": name,
-                                        "response": {"result": result},
-                                        "id": call_id
-                                    })
-                                    print("✅ delete_document executed")
-                                except Exception as e:
-                                    print(f"❌ delete_document error: {e}")
-                                    function_responses.append({
-                                        "name": name,
-                                        "response": {"error": str(e)},
-                                        "id": call_id
-                                    })
-                        
-                        # Send function responses back to Gemini
-                        if function_responses:
-                            await gemini_ws.send(json.dumps({
-                                "tool_response": {"function_responses": function_responses}
-                            }))
+                        run_in_background(handle_tool_call(function_calls))
+                        continue
+                    
+                    # The user interrupted; stop work whose answer will never be used
+                    if "toolCallCancellation" in response:
+                        ids = response["toolCallCancellation"].get("ids", [])
+                        print(f"🚫 Tool calls cancelled: {ids}")
+                        for call_id in ids:
+                            cancel_tool_call(call_id)
                         continue
                     
                     # Forward server content to client
                     if "serverContent" in response:
                         server_content = response["serverContent"]
-                        print(f"📦 Server content: {json.dumps(server_content, indent=2, default=str)[:500]}...")
+                        if DEBUG:
+                            print(f"📦 Server content: {json.dumps(server_content, indent=2, default=str)[:500]}...")
                         
                         # Extract text
                         if "modelTurn" in server_content:
                             parts = server_content["modelTurn"].get("parts", [])
-                            print(f"📝 Parts found: {len(parts)}")
+                            if DEBUG:
+                                print(f"📝 Parts found: {len(parts)}")
                             for i, part in enumerate(parts):
-                                print(f"🔸 Part {i}: {json.dumps(part, indent=2, default=str)[:200]}...")
+                                if DEBUG:
+                                    print(f"🔸 Part {i}: {json.dumps(part, indent=2, default=str)[:200]}...")
+                                if "inlineData" in part:
+                                    await downstream.put(client_audio_frame(part["inlineData"]["data"], binary_audio))
+                                    continue
+                                
                                 if "text" in part:
                                     print(f"💬 Text: {part['text'][:50]}...")
-                                    await client_websocket.send(json.dumps({"text": part["text"]}))
-                                
-                                if "inlineData" in part:
-                                    print(f"🔊 Audio data found")
-                                    await client_websocket.send(json.dumps({
-                                        "audio": part["inlineData"]["data"]
-                                    }))
+                                    await downstream.put(json.dumps({"text": part["text"]}), is_audio=False)
+
                                 if "codeExecutionResult" in part:
                                     result_text = part["codeExecutionResult"].get("output", "").strip()
                                     if result_text:
@@ -404,100 +1881,509 @@ async def gemini_session_handler(client_websocket):
                                             # Prefix with DocTalk
                                             formatted_result = f"DocTalk: {clean_result}"
                                             print(f"🔧 Tool result: {formatted_result}")
-                                            await client_websocket.send(json.dumps({"text": formatted_result}))
+                                            await downstream.put(json.dumps({"text": formatted_result}), is_audio=False)
                                         except (ValueError, SyntaxError) as e:
                                             # Fallback if parsing fails
                                             formatted_result = f"DocTalk: {result_text}"
                                             print(f"🔧 Tool result (fallback): {formatted_result}")
-                                            await client_websocket.send(json.dumps({"text": formatted_result}))
+                                            await downstream.put(json.dumps({"text": formatted_result}), is_audio=False)
                         
                         if server_content.get("turnComplete"):
                             print("✅ Turn complete - clearing transcription chunks")
                             # ← CRITICAL FIX: Clear transcription chunks after each complete turn
                             transcription_chunks = []
+                            if transcriber:
+                                usage = transcriber.end_turn()
+                                print(f"🗣️ Turn transcription: {usage['audio_seconds']:.1f}s audio streamed, "
+                                      f"{usage['results']} results, {usage['dropped']} frames dropped")
                     
             except websockets.exceptions.ConnectionClosed:
                 print("🔌 Gemini disconnected")
             except Exception as e:
                 print(f"❌ gemini_to_client error: {e}")
         
-        # Run both relay tasks concurrently
-        await asyncio.gather(
-            client_to_gemini(),
-            gemini_to_client(),
-            return_exceptions=True
-        )
+        async def write_frames(relay_queue, websocket):
+            """Writer side of a relay queue"""
+            try:
+                while True:
+                    frame, queued_at = await relay_queue.get()
+                    await websocket.send(frame)
+                    relay_frame_seconds.observe(time.perf_counter() - queued_at)
+            except websockets.exceptions.ConnectionClosed:
+                print(f"🔌 {relay_queue.name} writer closed")
+        
+        # Run readers and writers concurrently; the session ends when any side stops
+        relay_tasks = [
+            asyncio.create_task(client_to_gemini()),
+            asyncio.create_task(gemini_to_client()),
+            asyncio.create_task(write_frames(upstream, gemini_ws)),
+            asyncio.create_task(write_frames(downstream, client_websocket)),
+        ]
+        if transcriber:
+            relay_tasks.append(asyncio.create_task(forward_transcripts()))
+        try:
+            await asyncio.wait(relay_tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in relay_tasks:
+                task.cancel()
+            await asyncio.gather(*relay_tasks, return_exceptions=True)
         
     except Exception as e:
         print(f"❌ Session error: {e}")
         import traceback
         traceback.print_exc()
     finally:
+        active_sessions.discard(asyncio.current_task())
+        if user_id in user_sockets:
+            user_sockets[user_id].discard(client_websocket)
+            if not user_sockets[user_id]:
+                del user_sockets[user_id]
+        relay = active_relays.pop(session_id, None)
+        if relay:
+            print(f"📊 Relay queues: upstream {relay['upstream'].stats()}, downstream {relay['downstream'].stats()}")
+        for task, cancelled in pending_tool_calls.values():
+            cancelled.set()
+            task.cancel()
+        if transcriber:
+            transcriber.close()
+            print(f"🗣️ Transcription: {transcriber.streams} recognizer streams")
         if gemini_ws:
             await gemini_ws.close()
+        if retriever_load:
+            await asyncio.gather(retriever_load, return_exceptions=True)
+            await run_io(retriever.release_user, user_id)
         print(f"🏁 Session ended for {user_id}")
         
+class IngestLock:
+    """Cross-process lock per (user, filename) so workers never index the same document at once"""
+
+    def __init__(self, user_id, filename):
+        name = hashlib.sha256(f"{user_id}/{filename}".encode()).hexdigest()
+        self.path = os.path.join(INGEST_LOCK_DIR, name)
+        self._fd = None
+
+    def acquire(self):
+        os.makedirs(INGEST_LOCK_DIR, exist_ok=True)
+        self._fd = os.open(self.path, os.O_CREAT | os.O_RDWR)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+
+    def release(self):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+async def handle_client_tool_call(client_websocket, user_id, call):
+    """Run a tool call sent directly by the client"""
+    fn = call.get("name")
+    args = call.get("args", {})
+    if fn == "delete_document":
+        result = await delete_document_async(user_id, args.get("filename", ""))
+        await client_websocket.send(json.dumps({"text": f"✅ {result}"}))
+    elif fn == "query_docs":
+        result = await query_docs_async(args.get("query", ""), user_id)
+        await client_websocket.send(json.dumps({"text": f"🔍 {result}"}))
+
+def download_pdf(storage_path):
+    download_response = get_supabase().storage.from_("pdfs").download(storage_path)
+    if isinstance(download_response, bytes):
+        return download_response
+    elif hasattr(download_response, 'data'):
+        return download_response.data
+    else:
+        return download_response.read() if hasattr(download_response, 'read') else download_response
+
+# === Ingestion jobs ===
+class IngestJobStore:
+    """SQLite-backed queue of PDF indexing jobs on the persistent disk.
+
+    Extracted page texts are checkpointed per job, and stored chunks are
+    recognized by their hashes, so a job picked up again after a crash skips
+    both the extraction (OCR) and the embedding work already done.
+    """
+
+    def __init__(self, path=JOB_DB_PATH):
+        self.path = path
+        self._ready = False
+
+    def _connect(self):
+        if not self._ready:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        if not self._ready:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id TEXT NOT NULL,
+                    filename TEXT NOT NULL,
+                    storage_path TEXT NOT NULL,
+                    ocr_mode TEXT NOT NULL,
+                    chunking TEXT,
+                    status TEXT NOT NULL DEFAULT 'queued',
+                    pages_extracted INTEGER NOT NULL DEFAULT 0,
+                    chunks_embedded INTEGER NOT NULL DEFAULT 0,
+                    rows_stored INTEGER NOT NULL DEFAULT 0,
+                    error TEXT,
+                    worker_pid INTEGER,
+                    updated_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS job_pages (
+                    job_id INTEGER NOT NULL,
+                    page_number INTEGER NOT NULL,
+                    text TEXT NOT NULL,
+                    PRIMARY KEY (job_id, page_number)
+                );
+            """)
+            try:
+                db.execute("ALTER TABLE jobs ADD COLUMN chunking TEXT")  # databases from before per-upload chunking
+            except sqlite3.OperationalError:
+                pass
+            self._ready = True
+        return db
+
+    def enqueue(self, user_id, filename, storage_path, ocr_mode, chunking=None):
+        with closing_db(self._connect()) as db:
+            cursor = db.execute(
+                "INSERT INTO jobs (user_id, filename, storage_path, ocr_mode, chunking, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (user_id, filename, storage_path, json.dumps(ocr_mode), json.dumps(chunking or {}), time.time())
+            )
+            return cursor.lastrowid
+
+    def get(self, job_id):
+        with closing_db(self._connect()) as db:
+            row = db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                return None
+            return dict(row, ocr_mode=json.loads(row["ocr_mode"]), chunking=json.loads(row["chunking"] or "{}"))
+
+    def claim(self, job_id):
+        """Atomically take a queued job, or one whose worker stopped reporting progress"""
+        stale = time.time() - JOB_STALE_AFTER
+        with closing_db(self._connect()) as db:
+            cursor = db.execute(
+                "UPDATE jobs SET status = 'running', worker_pid = ?, updated_at = ? "
+                "WHERE id = ? AND (status = 'queued' OR (status = 'running' AND updated_at < ?))",
+                (os.getpid(), time.time(), job_id, stale)
+            )
+            return cursor.rowcount == 1
+
+    def touch_queued(self, job_id):
+        """Mark a queued job as still wanted, so recovery in other workers leaves it alone"""
+        with closing_db(self._connect()) as db:
+            db.execute("UPDATE jobs SET updated_at = ? WHERE id = ? AND status = 'queued'", (time.time(), job_id))
+
+    def claimable(self):
+        stale = time.time() - JOB_STALE_AFTER
+        with closing_db(self._connect()) as db:
+            rows = db.execute(
+                "SELECT id FROM jobs WHERE status IN ('queued', 'running') AND updated_at < ? ORDER BY id",
+                (stale,)
+            ).fetchall()
+            return [row["id"] for row in rows]
+
+    def update(self, job_id, **fields):
+        fields["updated_at"] = time.time()
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        with closing_db(self._connect()) as db:
+            db.execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+
+    def save_page(self, job_id, page_number, text):
+        with closing_db(self._connect()) as db:
+            db.execute(
+                "INSERT OR REPLACE INTO job_pages (job_id, page_number, text) VALUES (?, ?, ?)",
+                (job_id, page_number, text)
+            )
+            db.execute("UPDATE jobs SET pages_extracted = ?, updated_at = ? WHERE id = ?",
+                       (page_number + 1, time.time(), job_id))
+
+    def load_pages(self, job_id):
+        with closing_db(self._connect()) as db:
+            rows = db.execute("SELECT page_number, text FROM job_pages WHERE job_id = ?", (job_id,)).fetchall()
+            return {row["page_number"]: row["text"] for row in rows}
+
+    def finish(self, job_id, status, error=None):
+        with closing_db(self._connect()) as db:
+            db.execute("UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE id = ?",
+                       (status, error, time.time(), job_id))
+            db.execute("DELETE FROM job_pages WHERE job_id = ?", (job_id,))
+
+class closing_db:
+    """Close a sqlite3 connection on exit (its own context manager only commits)"""
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        return self.db
+
+    def __exit__(self, *exc):
+        self.db.close()
+
+ingest_jobs = IngestJobStore()
+_ingest_slots = None
+_local_jobs = set()  # job ids this process is waiting on or running
+
+def ingest_slot():
+    """Per-process cap on concurrently running ingestion jobs"""
+    global _ingest_slots
+    if _ingest_slots is None:
+        _ingest_slots = asyncio.Semaphore(INGEST_CONCURRENCY)
+    return _ingest_slots
+
+async def notify_user(user_id, message):
+    """Send a message to every session this user has open on this worker"""
+    payload = json.dumps(message)
+    for websocket in list(user_sockets.get(user_id, ())):
+        try:
+            await websocket.send(payload)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+def run_job(job, content_hash, pdf_bytes, report):
+    """Blocking part of a job: extract (resuming from checkpointed pages), embed and store"""
+    job_id = job["id"]
+    known_pages = ingest_jobs.load_pages(job_id)
+    if known_pages:
+        print(f"♻️ Resuming job {job_id}: {len(known_pages)} pages already extracted")
+    stats = {}
+
+    def checkpointed_pages():
+        for page_number, text in enumerate(iter_page_texts(pdf_bytes, job["ocr_mode"], stats, known_pages)):
+            if page_number not in known_pages:
+                ingest_jobs.save_page(job_id, page_number, text)
+            report(pages_extracted=page_number + 1)
+            yield text
+
+    def stored(store_stats):
+        fields = {"chunks_embedded": store_stats["embedded"] + store_stats["reused"],
+                  "rows_stored": store_stats["stored"]}
+        ingest_jobs.update(job_id, **fields)
+        report(**fields)
+
+    store_chunks_and_embeddings(job["user_id"], job["filename"], checkpointed_pages(), stored, job["chunking"])
+    # Only record the hash once the chunks are stored, so a failed run is retried
+    set_document_hash(job["user_id"], job["filename"], content_hash)
+    return stats
+
+async def keep_queued(job_id):
+    """Refresh a queued job while it waits for a slot or the document lock"""
+    while True:
+        await asyncio.sleep(JOB_STALE_AFTER / 3)
+        await run_io(ingest_jobs.touch_queued, job_id)
+
+async def run_ingest_job(job_id):
+    """Wait for a slot, claim and run one job, streaming progress to the owner's sessions"""
+    if job_id in _local_jobs:
+        return
+    job = await run_io(ingest_jobs.get, job_id)
+    if job is None or job["status"] not in ("queued", "running"):
+        return
+    _local_jobs.add(job_id)
+    user_id, filename = job["user_id"], job["filename"]
+    loop = asyncio.get_running_loop()
+    progress = {"job_id": job_id, "filename": filename, "status": "running",
+                "pages_extracted": 0, "chunks_embedded": 0, "rows_stored": 0}
+
+    def report(**fields):
+        # called from the worker thread
+        progress.update(fields)
+        snapshot = dict(progress)
+        loop.call_soon_threadsafe(run_in_background, notify_user(user_id, {"ingest_progress": snapshot}))
+
+    claimed = False
+    waiting = asyncio.create_task(keep_queued(job_id))
+    try:
+        async with ingest_slot(), user_slot(user_id, "ingest"):
+            # Another worker may be indexing the same document; wait for it so the
+            # hash check below sees its result
+            lock = IngestLock(user_id, filename)
+            await run_io(lock.acquire)
+            try:
+                # Claim only once everything is held, so a job stays "queued" (and
+                # refreshed) while it waits instead of turning stale as "running"
+                waiting.cancel()
+                claimed = await run_io(ingest_jobs.claim, job_id)
+                if not claimed:
+                    return  # another worker ran it in the meantime
+                print(f"📄 Processing {filename} (job {job_id})")
+                
+                # Download from Supabase
+                pdf_bytes = await run_io(download_pdf, job["storage_path"])
+                
+                # Skip re-indexing an identical upload
+                content_hash = document_hash(pdf_bytes, job["ocr_mode"], job["chunking"])
+                if await run_io(get_document_hash, user_id, filename) == content_hash:
+                    print(f"⏭️ {filename} unchanged, skipping re-index")
+                    await run_io(ingest_jobs.finish, job_id, "done")
+                    progress["status"] = "done"
+                    await notify_user(user_id, {"ingest_progress": dict(progress)})
+                    await notify_user(user_id, {"text": f"✅ '{filename}' already indexed"})
+                    return
+                
+                # Store metadata
+                await run_io(lambda: get_supabase().table("user_documents").upsert({
+                    "user_id": user_id,
+                    "filename": filename,
+                    "original_path": job["storage_path"]
+                }, on_conflict="user_id,filename").execute())
+                
+                # Extract, chunk, embed and store page by page straight from memory
+                stats = await run_io(run_job, job, content_hash, pdf_bytes, report)
+            finally:
+                lock.release()
+        
+        await run_io(ingest_jobs.finish, job_id, "done")
+        progress["status"] = "done"
+        await notify_user(user_id, {"ingest_progress": dict(progress)})
+        summary = ""
+        if job["ocr_mode"] == "auto":
+            print(f"  🧮 Auto extraction: {stats['ocr_pages']} pages OCR'd, {stats['native_pages']} extracted natively")
+            summary = f" ({stats['ocr_pages']} pages OCR'd, {stats['native_pages']} native)"
+        await notify_user(user_id, {"text": f"✅ '{filename}' uploaded & indexed{summary}"})
+    except Exception as e:
+        print(f"❌ PDF error: {e}")
+        if not claimed:
+            return  # still queued; recovery retries it
+        await run_io(ingest_jobs.finish, job_id, "failed", str(e))
+        progress["status"] = "failed"
+        await notify_user(user_id, {"ingest_progress": dict(progress)})
+        await notify_user(user_id, {"text": f"❌ Error: {str(e)}"})
+    finally:
+        waiting.cancel()
+        _local_jobs.discard(job_id)
+
 async def process_pdf(client_websocket, user_id, chunk):
-    """Process PDF upload separately"""
+    """Queue a PDF upload for indexing and run it on this worker"""
     try:
         filename = chunk["filename"]
-        storage_path = chunk["storage_path"]
-        use_ocr = chunk.get("ocr", False)
-        
-        print(f"📄 Processing {filename}")
-        
-        # Download from Supabase
-        download_response = supabase.storage.from_("pdfs").download(storage_path)
-        if isinstance(download_response, bytes):
-            pdf_bytes = download_response
-        elif hasattr(download_response, 'data'):
-            pdf_bytes = download_response.data
-        else:
-            pdf_bytes = download_response.read() if hasattr(download_response, 'read') else download_response
-        
-        # Store metadata
-        supabase.table("user_documents").upsert({
-            "user_id": user_id,
-            "filename": filename,
-            "original_path": storage_path
-        }, on_conflict="user_id,filename").execute()
-        
-        # Extract and store
-        os.makedirs("./tmp", exist_ok=True)
-        tmp_path = f"./tmp/{filename.replace('/', '_')}"
-        
-        try:
-            with open(tmp_path, "wb") as f:
-                f.write(pdf_bytes)
-            
-            text = extract_text_with_ocr(tmp_path) if use_ocr else extract_text_no_ocr(tmp_path)
-            store_chunks_and_embeddings(user_id, filename, text)
-            
-            await client_websocket.send(json.dumps({
-                "text": f"✅ '{filename}' uploaded & indexed"
-            }))
-        finally:
-            if os.path.exists(tmp_path):
-                os.remove(tmp_path)
-                
+        # Optional per-document chunk sizes in tokens
+        chunking = {key: int(chunk[key]) for key in ("chunk_size", "chunk_overlap") if chunk.get(key)}
+        job_id = await run_io(
+            ingest_jobs.enqueue, user_id, filename, chunk["storage_path"],
+            chunk.get("ocr", False),  # True, False or "auto"
+            chunking
+        )
+        await client_websocket.send(json.dumps({
+            "ingest_progress": {"job_id": job_id, "filename": filename, "status": "queued"}
+        }))
+        await run_ingest_job(job_id)
     except Exception as e:
         print(f"❌ PDF error: {e}")
-        await client_websocket.send(json.dumps({"text": f"❌ Error: {str(e)}"}))
+        try:
+            await client_websocket.send(json.dumps({"text": f"❌ Error: {str(e)}"}))
+        except websockets.exceptions.ConnectionClosed:
+            print("🔌 Client gone before PDF result could be sent")
+
+async def recover_ingest_jobs():
+    """Pick up jobs left queued or half-done by a worker that died or restarted"""
+    while True:
+        try:
+            for job_id in await run_io(ingest_jobs.claimable):
+                run_in_background(run_ingest_job(job_id))
+        except Exception as e:
+            print(f"⚠️ Job recovery failed: {e}")
+        await asyncio.sleep(JOB_RECOVERY_INTERVAL)
+
+
+async def drain(server):
+    """Stop accepting connections and give in-flight sessions and ingestion time to finish"""
+    pending = active_sessions | background_jobs
+    print(f"🛑 Draining {len(active_sessions)} sessions and {len(background_jobs)} jobs (up to {DRAIN_TIMEOUT:.0f}s)")
+    server.close(close_connections=False)
+    await gemini_pool.close()  # no new sessions will take the pre-warmed ones
+    if pending:
+        await asyncio.wait(pending, timeout=DRAIN_TIMEOUT)
+    server.close()  # anything still open is closed with 1001 going away
+    await server.wait_closed()
 
 
 async def main():
     PORT = int(os.environ.get("PORT", 9084))
-    async with websockets.serve(
+    
+    loop = asyncio.get_running_loop()
+    stop = loop.create_future()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, lambda: stop.done() or stop.set_result(None))
+    
+    server = await websockets.serve(
         gemini_session_handler,
         "0.0.0.0",
         PORT,
         max_size=50 * 1024 * 1024,
         ping_interval=20,
-        ping_timeout=20
-    ):
-        print(f"🚀 Server running on port {PORT}")
-        await asyncio.Future()
+        ping_timeout=20,
+        process_request=serve_metrics,
+        reuse_port=WEB_CONCURRENCY > 1
+    )
+    print(f"🚀 Server running on port {PORT} (pid {os.getpid()})")
+    metrics_server = None
+    if METRICS_PORT and METRICS_PATH:
+        # The handler is never reached: serve_metrics_only answers every request
+        metrics_server = await websockets.serve(
+            gemini_session_handler, "0.0.0.0", METRICS_PORT + (worker_id or 0), process_request=serve_metrics_only
+        )
+        print(f"📊 Metrics on port {METRICS_PORT + (worker_id or 0)}{METRICS_PATH}")
+    
+    # Client setup and the embedding probe happen once we can already accept connections
+    warmup = asyncio.create_task(run_io(warm_clients))
+    gemini_pool.start()
+    recovery = asyncio.create_task(recover_ingest_jobs())
+    await stop
+    warmup.cancel()
+    recovery.cancel()
+    await drain(server)
+    if metrics_server:
+        metrics_server.close()
+        await metrics_server.wait_closed()
 
 
-if __name__ == "__main__":
+def run_worker(worker):
+    global worker_id
+    worker_id = worker
+    print(f"👷 Worker {worker_id} starting (pid {os.getpid()})")
     asyncio.run(main())
+
+
+def supervise(workers):
+    """
+    Fork `workers` server processes that share the port via SO_REUSEPORT,
+    restart any that crash, and forward SIGTERM/SIGINT so each one drains.
+    """
+    context = multiprocessing.get_context("fork")
+    processes = {}
+    stopping = False
+
+    def start(worker_id):
+        process = context.Process(target=run_worker, args=(worker_id,), name=f"doctalk-worker-{worker_id}")
+        process.start()
+        processes[worker_id] = process
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for process in processes.values():
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for worker_id in range(workers):
+        start(worker_id)
+    print(f"🧑‍🏭 Supervising {workers} workers")
+    while not stopping:
+        for worker_id, process in list(processes.items()):
+            if not process.is_alive() and not stopping:
+                print(f"⚠️ Worker {worker_id} exited ({process.exitcode}), restarting")
+                start(worker_id)
+        time.sleep(1)
+    for process in processes.values():
+        process.join()
+
+
+if __name__ == "__main__":
+    if WEB_CONCURRENCY > 1:
+        supervise(WEB_CONCURRENCY)
+    else:
+        asyncio.run(main())